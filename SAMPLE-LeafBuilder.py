@@ -3,20 +3,84 @@ from cvplibrary import GlobalVariableNames as cvp_names
 from cvplibrary import RestClient
 from cvplibrary import Form
 
-import netaddr
-import jsonrpclib
+import threading
+import socket
+import sys
 import json
-import requests
+import re
+import array
+import os
+import bisect
+import time
+import random
+
+# IPv4 addresses are handled as plain ints
+# IPv4Network covers the parts of netaddr.IPNetwork the builders use
+def ip_to_int(text):
+    octets = [int(octet) for octet in text.split('.')]
+    if len(octets) != 4 or [octet for octet in octets if not 0 <= octet <= 255]:
+        raise ValueError('invalid IPv4 address %s' % text)
+    return (octets[0] << 24) | (octets[1] << 16) | (octets[2] << 8) | octets[3]
+
+def int_to_ip(value):
+    return '%s.%s.%s.%s' % (value >> 24, (value >> 16) & 255, (value >> 8) & 255, value & 255)
+
+# str() keeps the address as given, like netaddr, while first, last, network
+# and indexing work on the masked network address
+class IPv4Network(object):
+    __slots__ = ('ip', 'prefixlen')
+
+    def __init__(self, ip, prefixlen=32):
+        if isinstance(ip, basestring):
+            if '/' in ip:
+                ip, prefixlen = ip.split('/')
+            ip = ip_to_int(ip)
+        prefixlen = int(prefixlen)
+        if not 0 <= prefixlen <= 32:
+            raise ValueError('invalid prefix length %s' % prefixlen)
+        self.ip = ip
+        self.prefixlen = prefixlen
+
+    @property
+    def size(self):
+        return 2 ** (32 - self.prefixlen)
+
+    @property
+    def first(self):
+        return self.ip & ~(self.size - 1)
+
+    @property
+    def last(self):
+        return self.first + self.size - 1
+
+    @property
+    def network(self):
+        return int_to_ip(self.first)
+
+    # Address at index from the network address, negative indexes count back
+    # from the broadcast address
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError('no address at index %s in %s' % (index, self))
+        return int_to_ip(self.first + index)
+
+    def __str__(self):
+        return '%s/%s' % (int_to_ip(self.ip), self.prefixlen)
+
+    def __repr__(self):
+        return 'IPv4Network(%r)' % str(self)
 
 # Set Form Variables and static
 lo0 = Form.getFieldById('lo0').getValue()
-lo0 = netaddr.IPNetwork('%s/32' % lo0)
+lo0 = IPv4Network(lo0, 32)
 lo1 = Form.getFieldById('lo1').getValue()
-lo1 = netaddr.IPNetwork('%s/32' % lo1)
+lo1 = IPv4Network(lo1, 32)
 lo1_sec = Form.getFieldById('lo1_sec').getValue()
-lo1_sec = netaddr.IPNetwork('%s/32' % lo1_sec)
+lo1_sec = IPv4Network(lo1_sec, 32)
 mlag_subnet = Form.getFieldById('mlag_subnet').getValue()
-mlag_subnet = netaddr.IPNetwork(mlag_subnet)
+mlag_subnet = IPv4Network(mlag_subnet)
 leaf_asn = Form.getFieldById('leaf_asn').getValue()
 spine_asn = Form.getFieldById('spine_asn').getValue()
 mac = cvp_vars.getValue(cvp_names.CVP_MAC)
@@ -28,15 +92,113 @@ mlag_peer_ints.append('Ethernet1')
 mlag_ints = list()
 mlag_ints.append('Ethernet4')
 
+# Fabric p2p plan, spine hostname -> (supernet Form value, interfaces) of its SpineBuilder
+# or (supernet, interface -> spine address) for spines that allocate from a ledger
+# Uplink addresses on spines in the plan are derived without querying the spine
+# Spines missing from the plan are queried over eAPI instead
+# Can be changed to fit environment
+p2p_cidr = 31
+spine_plan = dict()
+#spine_plan['spine1'] = ('10.0.0.0/24', ['Ethernet%s' % n for n in range(1, 33)])
+
+# fabric_build.py hands over the plan of the spines it built in SPINE_PLAN_FILE
+if os.environ.get('SPINE_PLAN_FILE'):
+    with open(os.environ['SPINE_PLAN_FILE']) as f:
+        spine_plan.update(json.load(f))
+
+# How LLDP neighbors are read, only the neighbors on routed_ints are kept
+#  'full'    one 'show lldp neighbors detail' parsed in full
+#  'scoped'  one 'show lldp neighbors <interface> detail' per interface, in one request
+#  'stream'  one 'show lldp neighbors detail', only the needed interfaces are decoded
+# Can be changed to fit environment
+lldp_mode = 'full'
+
+# Uplinks are discovered in parallel, set to 1 to discover them one at a time
+# Can be changed to fit environment
+discovery_workers = 4
+
+# CVP inventory entries are looked up by MAC, IP or fqdn. With inventory_dir
+# set they are kept there in one snapshot shared by the builds and read from
+# it while younger than inventory_ttl seconds. Devices missing from it or
+# older than that are fetched one by one and written back together once the
+# build is done, so a build takes the snapshot lock at most once.
+# fabric_crawl.py --inventory-dir fills it with the whole inventory at once.
+# None disables the snapshot, every device is then fetched one by one
+# Can be changed to fit environment
+inventory_dir = None
+inventory_ttl = 3600
+inventory = None
+inventory_fetched = dict()
+inventory_lock = threading.Lock()
+
 # Functions to build leaf configuration
+def get_cvp(url):
+    client = TimedRestClient(url, 'GET')
+    call_device('cvp %s' % url.split('?')[0], client.connect)
+    return json.loads(client.getResponse())
+
+# Returns the snapshot in inventory_dir, MAC -> [time fetched, entry]
+def read_inventory():
+    if not inventory_dir:
+        return dict()
+    try:
+        with open(os.path.join(inventory_dir, 'inventory.json')) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return dict()
+
+# Adds the entries fetched by this build to the snapshot, read again first as
+# other builds may have added to it meanwhile
+def save_inventory():
+    if not inventory_dir or not inventory_fetched:
+        return
+    path = os.path.join(inventory_dir, 'inventory.json')
+    while not take_lock(path + '.lock'):
+        wait_for('inventory')
+    try:
+        snapshot = read_inventory()
+        snapshot.update(inventory_fetched)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(snapshot, f)
+        os.rename(path + '.tmp', path)
+    finally:
+        os.remove(path + '.lock')
+
+def add_net_element(index, fetched, node):
+    # Inventory pages may return ztpMode as a boolean
+    node['ztpMode'] = str(node['ztpMode']).lower()
+    for key in (('mac', node['systemMacAddress']), ('ip', node['ipAddress']), ('fqdn', node['fqdn'])):
+        index[key] = (fetched, node)
+
+# Returns the inventory entry whose field ('mac', 'ip' or 'fqdn') matches value
+# or None if it is not in the snapshot or is older than inventory_ttl
+def find_net_element(field, value):
+    global inventory
+    with inventory_lock:
+        if inventory is None:
+            inventory = dict()
+            for fetched, node in read_inventory().values():
+                add_net_element(inventory, fetched, node)
+        entry = inventory.get((field, value))
+    if entry is None or time.time() - entry[0] > inventory_ttl:
+        return None
+    return entry[1]
+
 def get_net_element(system_mac):
-    url='http://localhost:8080/cvpservice/provisioning/getNetElementById.do?netElementId=%s' % system_mac
-    client = RestClient(url,'GET')
-    client.connect()
-    node_info = json.loads(client.getResponse())
+    node_info = find_net_element('mac', system_mac)
+    if node_info is None:
+        url='http://localhost:8080/cvpservice/provisioning/getNetElementById.do?netElementId=%s' % system_mac
+        node_info = coalesce('cvp', url, get_cvp, url)
+        fetched = time.time()
+        with inventory_lock:
+            add_net_element(inventory, fetched, node_info)
+            inventory_fetched[system_mac] = [fetched, node_info]
     return node_info
 
-def get_credentials(ztp=cvp_vars.getValue(cvp_names.ZTP_STATE)):
+# ZTP_STATE is read when credentials are first needed, not when the builder loads
+def get_credentials(ztp=None):
+    if ztp is None:
+        ztp = cvp_vars.getValue(cvp_names.ZTP_STATE)
     if ztp == 'true':
         user = cvp_vars.getValue(cvp_names.ZTP_USERNAME)
         pwd = cvp_vars.getValue(cvp_names.ZTP_PASSWORD)
@@ -45,133 +207,747 @@ def get_credentials(ztp=cvp_vars.getValue(cvp_names.ZTP_STATE)):
         pwd = cvp_vars.getValue(cvp_names.CVP_PASSWORD)
     return (user, pwd)
 
+# Calls to devices and CVP share a latency budget of build_budget seconds
+# Each call times out after call_timeout seconds. Calls that time out or fail
+# to connect are retried up to call_retries times with a jittered backoff
+# while the budget lasts, other errors are raised at once. A device that
+# fails breaker_threshold calls in a row is not called again
+# Shared with the other eAPI builders, check_shared.py keeps the copies identical
+# Can be changed to fit environment
+build_budget = 60
+call_timeout = 10
+call_retries = 2
+retry_backoff = 0.5
+breaker_threshold = 3
+build_deadline = time.time() + build_budget
+breaker = dict()
+breaker_lock = threading.Lock()
+
+class DeviceUnavailable(Exception):
+    pass
+
+# Errors worth a retry, the call timed out or the connection failed. HTTP
+# errors such as a 404 from CVP carry a code and are not retried
+def is_transient(e):
+    if isinstance(e, DeviceUnavailable):
+        return True
+    return isinstance(e, (socket.error, IOError)) and not hasattr(e, 'code')
+
+# Runs func(*args) in a separate thread and gives up after timeout seconds
+def call_with_timeout(func, args, timeout):
+    result = list()
+    def call():
+        try:
+            result.append((True, func(*args)))
+        except Exception:
+            result.append((False, sys.exc_info()))
+    thread = threading.Thread(target=call)
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    if not result:
+        raise DeviceUnavailable('call timed out after %.1fs' % timeout)
+    if not result[0][0]:
+        error = result[0][1]
+        raise error[0], error[1], error[2]
+    return result[0][1]
+
+# Runs func(*args) on device with call_timeout and retries inside the budget
+def call_device(device, func, *args):
+    attempt = 0
+    while True:
+        with breaker_lock:
+            failures = breaker.get(device, 0)
+        if failures >= breaker_threshold:
+            raise DeviceUnavailable('%s failed %s calls in a row' % (device, failures))
+        remaining = build_deadline - time.time()
+        if remaining <= 0:
+            raise DeviceUnavailable('build budget of %ss used up before calling %s' % (build_budget, device))
+        try:
+            result = call_with_timeout(func, args, min(call_timeout, remaining))
+        except Exception, e:
+            if not is_transient(e):
+                raise
+            with breaker_lock:
+                breaker[device] = breaker.get(device, 0) + 1
+            attempt += 1
+            if attempt > call_retries:
+                raise DeviceUnavailable('%s: %s' % (device, e))
+            delay = retry_backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+            time.sleep(max(0, min(delay, build_deadline - time.time())))
+            continue
+        with breaker_lock:
+            breaker[device] = 0
+        return result
+
+# Builders running at the same time can share their calls through
+# coalesce_dir. The first builder to make a call runs it and leaves the result
+# there for coalesce_ttl seconds, builders making the same call meanwhile wait
+# for that result instead of calling again. At most coalesce_limit calls run
+# against one device at a time. Spines are then asked for all of their
+# interface addresses at once, so leaves asking for different ports share a
+# call. Results are removed once expired. None disables it
+# Can be changed to fit environment
+coalesce_dir = None
+coalesce_ttl = 5
+coalesce_limit = 2
+coalesce_poll = 0.05
+
+# Creates the lock file at path, or removes it and returns False if it was
+# left behind by a builder that stopped before the end of its budget
+def take_lock(path):
+    try:
+        os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return True
+    except OSError:
+        try:
+            if time.time() - os.path.getmtime(path) > build_budget:
+                os.remove(path)
+        except OSError:
+            pass
+        return False
+
+def wait_for(device):
+    if time.time() > build_deadline:
+        raise DeviceUnavailable('build budget of %ss used up waiting for %s' % (build_budget, device))
+    time.sleep(coalesce_poll)
+
+# Removes the results older than coalesce_ttl, which no builder reads again
+def prune_results():
+    for name in os.listdir(coalesce_dir):
+        path = os.path.join(coalesce_dir, name)
+        if len(name) != 40 or '.' in name:
+            continue
+        try:
+            if time.time() - os.path.getmtime(path) > coalesce_ttl:
+                os.remove(path)
+        except OSError:
+            pass
+
+# Returns func(*args) for the call named by device and key, from the builder
+# running the same call when there is one
+def coalesce(device, key, func, *args):
+    if not coalesce_dir:
+        return func(*args)
+    import hashlib
+    path = os.path.join(coalesce_dir, hashlib.sha1(json.dumps([device, key])).hexdigest())
+    while True:
+        try:
+            if time.time() - os.path.getmtime(path) < coalesce_ttl:
+                with open(path) as f:
+                    return json.load(f)
+        except (OSError, IOError):
+            pass
+        if take_lock(path + '.lock'):
+            break
+        wait_for(device)
+
+    try:
+        slots = [os.path.join(coalesce_dir, '%s.%s' % (device.replace(':', '_'), n)) for n in range(coalesce_limit)]
+        slot = None
+        while slot is None:
+            slot = next((slot for slot in slots if take_lock(slot)), None)
+            if slot is None:
+                wait_for(device)
+        try:
+            result = func(*args)
+        finally:
+            os.remove(slot)
+        prune_results()
+        with open(path + '.tmp', 'w') as f:
+            json.dump(result, f)
+        os.rename(path + '.tmp', path)
+        return result
+    finally:
+        os.remove(path + '.lock')
+
+# 'show ip interface <port>' is sent as 'show ip interface' when calls are
+# coalesced, pick_output takes the port back out of its output
+def shared_command(command):
+    if coalesce_dir and command.startswith('show ip interface '):
+        return 'show ip interface'
+    return command
+
+def pick_output(command, output):
+    if shared_command(command) == command:
+        return output
+    port = command[len('show ip interface '):]
+    return {'interfaces': {port: output['interfaces'][port]}}
+
+# eAPI connections are pooled per device and kept open between calls
+# jsonrpclib is only imported when the first connection is opened
+# eapi_pool_size limits the idle connections kept for each device
+# Can be changed to fit environment
+eapi_pool_size = 4
+eapi_pool = dict()
+eapi_pool_lock = threading.Lock()
+
 def send_command(user, pwd, ip, commands, https=False):
-    if https:
-        url = 'https://%s:%s@%s/command-api' % (user, pwd, ip)
-    else:
-        url = 'http://%s:%s@%s/command-api' % (user, pwd, ip)
-    sw = jsonrpclib.Server(url)
+    return coalesce(ip, commands, call_device, ip, run_commands, user, pwd, ip, commands, https)
+
+def run_commands(user, pwd, ip, commands, https=False):
+    key = (user, pwd, ip, https)
+    with eapi_pool_lock:
+        idle = eapi_pool.setdefault(key, list())
+        sw = idle.pop() if idle else None
+    if sw is None:
+        if https:
+            url = 'https://%s:%s@%s/command-api' % (user, pwd, ip)
+        else:
+            url = 'http://%s:%s@%s/command-api' % (user, pwd, ip)
+        import jsonrpclib
+        sw = jsonrpclib.Server(url)
     result = sw.runCmds(1, commands)
+    with eapi_pool_lock:
+        if len(eapi_pool[key]) < eapi_pool_size:
+            eapi_pool[key].append(sw)
     return result
 
-def get_routed_info(interfaces):
+# Runs one command and returns the raw eAPI response text, without parsing it
+def fetch_command(user, pwd, ip, command, https=False):
+    import urllib2
+    import base64
+    url = '%s://%s/command-api' % ('https' if https else 'http', ip)
+    body = json.dumps({'jsonrpc': '2.0', 'method': 'runCmds', 'id': 1,
+                       'params': {'version': 1, 'cmds': [command]}})
+    request = urllib2.Request(url, body, {'Content-Type': 'application/json'})
+    request.add_header('Authorization', 'Basic %s' % base64.b64encode('%s:%s' % (user, pwd)))
+    return urllib2.urlopen(request).read()
+
+# Decodes the entries of the given keys from the JSON object named name in text
+# Only those entries are parsed, the rest of the text is skipped over
+def extract_entries(text, name, keys):
+    decoder = json.JSONDecoder()
+    start = text.find('"%s"' % name)
+    if start < 0:
+        raise ValueError('no %s in response: %s' % (name, text[:200]))
+    entries = dict()
+    for key in keys:
+        match = re.compile(r'"%s"\s*:\s*' % re.escape(key)).search(text, start)
+        if match:
+            entries[key] = decoder.raw_decode(text, match.end())[0]
+    return entries
+
+# Returns the LLDP neighbors of the switch at ip on interfaces, read as set by lldp_mode
+def get_lldp_info(user, pwd, ip, interfaces):
+    if lldp_mode == 'scoped':
+        commands = ['show lldp neighbors %s detail' % _int for _int in interfaces]
+        lldp_info = dict()
+        for result in send_command(user, pwd, ip, commands):
+            lldp_info.update(result['lldpNeighbors'])
+        return lldp_info
+    if lldp_mode == 'stream':
+        text = call_device(ip, fetch_command, user, pwd, ip, 'show lldp neighbors detail')
+        return extract_entries(text, 'lldpNeighbors', interfaces)
+    return send_command(user, pwd, ip, ['show lldp neighbors detail'])[0]['lldpNeighbors']
+
+# Builds the p2p addressing table for every spine in spine_plan
+# Matches get_p2p_table in SpineBuilder, p2p_cidr subnets of the supernet are
+# assigned to the sorted interfaces in order and the spine takes the first address
+# Spines planned with their addresses keep the addresses they were given
+# Returns hostname -> (offset, interface -> index) and one array of spine addresses
+def get_fabric_table(plan):
+    spines = dict()
+    table = array.array('I')
+    for name in sorted(plan.keys()):
+        supernet = IPv4Network(plan[name][0])
+        addresses = plan[name][1] if isinstance(plan[name][1], dict) else dict()
+        ports = dict()
+        for index, _int in enumerate(sorted(plan[name][1])):
+            first = supernet.first + index * 2 ** (32 - p2p_cidr)
+            ports[_int] = index
+            if _int in addresses:
+                table.append(ip_to_int(addresses[_int]))
+            else:
+                table.append(first if p2p_cidr == 31 else first + 1)
+        spines[name] = (len(table) - len(ports), ports)
+    return spines, table
+
+# Returns the (spine, leaf) addresses of a spine interface from the fabric table
+# or None if the spine or interface is not part of the plan
+def get_plan_ips(hostname, interface):
+    if hostname not in fabric_spines or interface not in fabric_spines[hostname][1]:
+        return None
+    offset, ports = fabric_spines[hostname]
+    spine_ip = fabric_table[offset + ports[interface]]
+    return int_to_ip(spine_ip), int_to_ip(spine_ip + 1)
+
+# Runs func on each item, discovery_workers items at a time in parallel threads
+# Results are returned in the same order as items
+def run_parallel(func, items):
+    items = list(items)
+    if discovery_workers <= 1:
+        return [func(item) for item in items]
+    
+    results = [None] * len(items)
+    pending = list(enumerate(items))
+    errors = list()
+    lock = threading.Lock()
+    
+    def worker():
+        while True:
+            with lock:
+                if not pending or errors:
+                    return
+                index, item = pending.pop(0)
+            try:
+                results[index] = func(item)
+            except Exception:
+                with lock:
+                    errors.append(sys.exc_info())
+    
+    threads = [threading.Thread(target=worker) for _ in range(min(discovery_workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+# Sends the commands of many requests with one runCmds per device
+# requests is a list of (user, pwd, ip, commands) and commands repeated for the
+# same device are only run once. Returns the results of each request in order
+def send_batch(requests):
+    devices = dict()
+    for user, pwd, ip, commands in requests:
+        key = (user, pwd, ip)
+        if key not in devices:
+            devices[key] = dict()
+        for command in commands:
+            devices[key].setdefault(shared_command(command), len(devices[key]))
+    
+    keys = devices.keys()
+    outputs = run_parallel(lambda key: send_command(key[0], key[1], key[2],
+                           sorted(devices[key], key=devices[key].get)), keys)
+    outputs = dict(zip(keys, outputs))
+    
+    results = list()
+    for user, pwd, ip, commands in requests:
+        key = (user, pwd, ip)
+        results.append([pick_output(command, outputs[key][devices[key][shared_command(command)]])
+                        for command in commands])
+    return results
+
+def get_uplink_info(_int, lldp_info):
+    lldp_neigh = lldp_info[_int]['lldpNeighborInfo'][0]
+    neigh_mac = lldp_neigh['chassisId'].replace('.','')
+    neigh_mac = ':'.join(a+b for a,b in zip(neigh_mac[::2], neigh_mac[1::2]))
+    neigh_int = lldp_neigh['neighborInterfaceInfo']['interfaceId'].replace('"','')
+    neigh_name = lldp_neigh['systemName'].split('.')[0]
+    plan_ips = get_plan_ips(neigh_name, neigh_int)
+    
+    entry = dict()
+    entry['localInt'] = _int
+    entry['localIp'] = plan_ips[1] if plan_ips else None
+    entry['neighMac'] = neigh_mac
+    entry['neighInt'] = neigh_int
+    entry['neighIp'] = plan_ips[0] if plan_ips else None
+    entry['cidr'] = p2p_cidr
+    entry['systemName'] = neigh_name
+    
+    return entry
+
+# Uplinks can be looked up in a topology index written by fabric_crawl.py
+# instead of being discovered. Leaves missing from the index, or an index
+# older than topology_ttl seconds, fall back to discovery. None disables it
+# Can be changed to fit environment
+topology_index = None
+topology_ttl = 3600
+topology = dict()
+
+def load_topology():
+    if not topology and topology_index and os.path.exists(topology_index):
+        with open(topology_index) as f:
+            index = json.load(f)
+        if time.time() - index['time'] < topology_ttl:
+            topology.update(index)
+    return topology
+
+# Devices the crawler could not reach keep their entries in the index, they
+# are used for topology_ttl seconds after they were last crawled
+def is_crawled(index, device):
+    entry = index['devices'].get(device)
+    return bool(entry) and time.time() - entry.get('time', index['time']) < topology_ttl
+
+# Returns the uplinks on interfaces of the switch with system_mac from the
+# topology index, in the form of get_uplink_info, or None if any is missing
+def get_indexed_uplinks(system_mac, interfaces):
+    index = load_topology()
+    if not index or not is_crawled(index, system_mac):
+        return None
     routed_info = list()
+    for _int in interfaces:
+        link = index['links'].get('%s %s' % (system_mac, _int))
+        address = index['addresses'].get('%s %s' % tuple(link)) if link else None
+        if not address or not is_crawled(index, link[0]):
+            return None
+        entry = dict()
+        entry['localInt'] = _int
+        entry['localIp'] = int_to_ip(ip_to_int(address[0]) + 1)
+        entry['neighMac'] = link[0]
+        entry['neighInt'] = link[1]
+        entry['neighIp'] = address[0]
+        entry['cidr'] = address[1]
+        entry['systemName'] = index['devices'][link[0]]['hostname']
+        routed_info.append(entry)
+    return routed_info
+
+def get_routed_info(interfaces):
+    routed_info = get_indexed_uplinks(mac, interfaces)
+    if routed_info is None:
+        user, pwd = get_credentials()
+        sw_ip = cvp_vars.getValue(cvp_names.CVP_IP)
+        lldp_info = get_lldp_info(user, pwd, sw_ip, interfaces)
+        routed_info = [get_uplink_info(_int, lldp_info) for _int in interfaces]
+    resolve_uplinks(routed_info)
+    return routed_info
+
+# Discovers the uplinks of this leaf and of its MLAG peer, the LLDP neighbor on
+# mlag_peer_ints, in one pass. Spine queries for both leaves share one batch
+# Returns this leaf's uplinks, the peer's MAC and the peer's uplinks
+def get_pair_routed_info(interfaces):
+    peer_link = load_topology().get('links', dict()).get('%s %s' % (mac, mlag_peer_ints[0]))
+    if peer_link:
+        routed_info = get_indexed_uplinks(mac, interfaces)
+        peer_info = get_indexed_uplinks(peer_link[0], interfaces)
+        if routed_info and peer_info:
+            return routed_info, peer_link[0], peer_info
     user, pwd = get_credentials()
     sw_ip = cvp_vars.getValue(cvp_names.CVP_IP)
-    commands = ['show lldp neighbors detail']
-    lldp_info = send_command(user, pwd, sw_ip, commands)[0]['lldpNeighbors']
+    lldp_info = get_lldp_info(user, pwd, sw_ip, interfaces + mlag_peer_ints[:1])
+    peer_mac = get_uplink_info(mlag_peer_ints[0], lldp_info)['neighMac']
+    peer = get_net_element(peer_mac)
+    _user, _pwd = get_credentials(peer['ztpMode'])
+    peer_lldp = get_lldp_info(_user, _pwd, peer['ipAddress'], interfaces)
     
-    for _int in interfaces:
-        lldp_neigh = lldp_info[_int]['lldpNeighborInfo'][0]
-        neigh_mac = lldp_neigh['chassisId'].replace('.','')
-        neigh_mac = ':'.join(a+b for a,b in zip(neigh_mac[::2], neigh_mac[1::2]))
-        neigh_int = lldp_neigh['neighborInterfaceInfo']['interfaceId'].replace('"','')
-        
-        node = get_net_element(neigh_mac)
+    routed_info = [get_uplink_info(_int, lldp_info) for _int in interfaces]
+    peer_info = [get_uplink_info(_int, peer_lldp) for _int in interfaces]
+    resolve_uplinks(routed_info + peer_info)
+    return routed_info, peer_mac, peer_info
+
+# Fills in the addresses of uplinks that are not in the fabric plan
+# Every spine is queried once for all of the entries that connect to it
+def resolve_uplinks(routed_info):
+    unplanned = [entry for entry in routed_info if not entry['neighIp']]
+    macs = sorted(set(entry['neighMac'] for entry in unplanned))
+    nodes = dict(zip(macs, run_parallel(get_net_element, macs)))
+    
+    requests = list()
+    for entry in unplanned:
+        node = nodes[entry['neighMac']]
         _user, _pwd = get_credentials(node['ztpMode'])
-        _commands = ['show ip interface %s' % neigh_int]
-        int_info = send_command(_user, _pwd, node['ipAddress'], _commands)[0]['interfaces']
+        _commands = ['show ip interface %s' % entry['neighInt']]
+        requests.append((_user, _pwd, node['ipAddress'], _commands))
+    
+    for entry, result in zip(unplanned, send_batch(requests)):
+        neigh_int = entry['neighInt']
+        int_info = result[0]['interfaces']
         cidr = int_info[neigh_int]['interfaceAddress']['primaryIp']['maskLen']
         neigh_ip = int_info[neigh_int]['interfaceAddress']['primaryIp']['address']
-        ip_info = neigh_ip.split('.')
-        local_ip = '%s.%s' % ('.'.join(ip_info[:3]), str(int(ip_info[-1])+1))
-        
-        entry = dict()
-        entry['localInt'] = _int
+        local_ip = int_to_ip(ip_to_int(neigh_ip) + 1)
         entry['localIp'] = local_ip
-        entry['neighMac'] = neigh_mac
-        entry['neighInt'] = neigh_int
         entry['neighIp'] = neigh_ip
         entry['cidr'] = cidr
-        entry['systemName'] = node['fqdn'].split('.')[0]
-        
-        routed_info.append(entry)
-        
-    return routed_info
+        entry['systemName'] = nodes[entry['neighMac']]['fqdn'].split('.')[0]
+
+# MLAG pairs are built in one pass when pair_dir is set. The first leaf of a
+# pair to build discovers the uplinks of both and leaves its peer's uplinks
+# and MLAG role in pair_dir, the peer then builds from them without discovery
+# Records older than pair_ttl seconds are ignored
+# Can be changed to fit environment
+pair_dir = None
+pair_ttl = 600
+
+def save_pair(device, facts, mlag_first):
+    path = os.path.join(pair_dir, '%s.json' % device)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'time': time.time(), 'facts': facts, 'mlag_first': mlag_first}, f)
+    os.rename(path + '.tmp', path)
+
+# Returns the record the MLAG peer left for device, at most once
+def load_pair(device):
+    if not pair_dir:
+        return None
+    path = os.path.join(pair_dir, '%s.json' % device)
+    try:
+        with open(path) as f:
+            pair = json.load(f)
+        os.remove(path)
+    except (IOError, OSError, ValueError):
+        return None
+    return pair if time.time() - pair['time'] < pair_ttl else None
+
+# The uplinks last discovered for each leaf are kept in facts_dir. When a
+# device cannot be reached during discovery they are used instead and the
+# configlet is marked stale, any other error fails the build
+# None disables the fallback
+# Can be changed to fit environment
+facts_dir = None
+
+def save_facts(device, facts):
+    if not facts_dir:
+        return
+    path = os.path.join(facts_dir, '%s.json' % device)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'time': time.time(), 'facts': facts}, f)
+    os.rename(path + '.tmp', path)
+
+# Returns (time, facts) last saved for device or None if there are none
+def load_facts(device):
+    if not facts_dir:
+        return None
+    try:
+        with open(os.path.join(facts_dir, '%s.json' % device)) as f:
+            saved = json.load(f)
+    except (IOError, ValueError):
+        return None
+    return saved['time'], saved['facts']
+
+# Build metrics, off by default
+# metrics_comment appends phase times, call latencies and peak memory to the
+# configlet as ! comments, metrics_file appends them to that file as JSON lines
+# Shared with the other builders, check_shared.py keeps the copies identical
+# Can be changed to fit environment
+metrics_comment = False
+metrics_file = None
+metrics_enabled = metrics_comment or bool(metrics_file)
+metrics_buckets = [0.005, 0.01, 0.05, 0.1, 0.5, 1, 5]
+metrics = {'phases': list(), 'phase': None, 'calls': dict()}
+metrics_lock = threading.Lock()
+
+# Ends the running phase and starts the next, None ends the last phase
+def mark_phase(name):
+    if not metrics_enabled:
+        return
+    now = time.time()
+    if metrics['phase']:
+        metrics['phases'].append((metrics['phase'][0], now - metrics['phase'][1]))
+    metrics['phase'] = (name, now) if name else None
+
+# Returns func with its calls timed under kind when metrics are enabled
+def instrument(kind, func):
+    if not metrics_enabled:
+        return func
+    def timed(*args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record_call(kind, time.time() - start)
+    return timed
+
+def record_call(kind, elapsed):
+    with metrics_lock:
+        if kind not in metrics['calls']:
+            metrics['calls'][kind] = {'count': 0, 'total': 0.0, 'max': 0.0,
+                                      'histogram': [0] * (len(metrics_buckets) + 1)}
+        calls = metrics['calls'][kind]
+        calls['count'] += 1
+        calls['total'] += elapsed
+        calls['max'] = max(calls['max'], elapsed)
+        calls['histogram'][bisect.bisect_left(metrics_buckets, elapsed)] += 1
+
+def get_metrics_report(device):
+    report = dict()
+    report['builder'] = os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else None
+    report['device'] = device
+    report['time'] = time.time()
+    report['phases'] = metrics['phases']
+    report['calls'] = metrics['calls']
+    report['buckets'] = metrics_buckets
+    try:
+        import resource
+        report['peak_memory_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        report['peak_memory_kb'] = None
+    return report
+
+def format_metrics(report):
+    lines = ['!! Builder metrics']
+    for name, elapsed in report['phases']:
+        lines.append('! phase %s: %.3fs' % (name, elapsed))
+    for kind in sorted(report['calls'].keys()):
+        calls = report['calls'][kind]
+        buckets = ['<=%sms:%s' % (int(limit * 1000), count)
+                   for limit, count in zip(report['buckets'], calls['histogram'])]
+        buckets.append('>%sms:%s' % (int(report['buckets'][-1] * 1000), calls['histogram'][-1]))
+        lines.append('! %s calls: %s, total %.3fs, max %.3fs' % (kind, calls['count'], calls['total'], calls['max']))
+        lines.append('!   %s' % ' '.join(buckets))
+    lines.append('! peak memory: %s KB' % report['peak_memory_kb'])
+    return '\n'.join(lines) + '\n'
+
+def write_metrics(device):
+    report = get_metrics_report(device)
+    if metrics_file:
+        import json
+        with metrics_lock:
+            with open(metrics_file, 'a') as f:
+                f.write(json.dumps(report) + '\n')
+    return format_metrics(report) if metrics_comment else ''
+
+# RestClient whose connect is timed as a 'rest' call when metrics are enabled
+class TimedRestClient(object):
+    def __init__(self, url, method):
+        self.client = RestClient(url, method)
+        self.connect = instrument('rest', self.client.connect)
+        self.getResponse = self.client.getResponse
+
+send_command = instrument('eapi', send_command)
+fetch_command = instrument('eapi', fetch_command)
+
+# Configuration templates
+# Each configlet is rendered into one buffer and written out once
+stale_template = """!! Stale facts
+! Discovery failed: %s
+! Uplinks below were discovered at %s
+
+"""
+
+mlag_vlan_template = """
+ip routing
+
+no spanning-tree vlan 4094
+
+vlan 4094
+   name MLAG_PEERLINK
+   trunk group mlagpeer
+
+interface Vlan4094
+   description MLAG_SVI
+   ip address %s/%s
+
+"""
+
+peer_int_template = """interface %s
+   switchport mode trunk
+   channel-group 10 mode active
+
+"""
+
+mlag_int_template = """interface %s
+   channel-group %s mode active
+
+"""
+
+mlag_po_template = """interface Port-Channel%s
+   switchport mode trunk
+   mlag %s
+
+"""
+
+mlag_config_template = """interface Port-Channe10
+   description MLAG-PEERLINK
+   switchport mode trunk
+   switchport trunk group mlagpeer
+
+mlag configuration
+   domain-id mlagDomain
+   local-interface Vlan4094
+   peer-address %s
+   peer-link Port-Channel10
+
+"""
+
+routed_int_template = """interface %s
+   description %s_%s
+   no switchport
+   ip address %s/%s
+
+"""
+
+loopback_template = """interface Loopback0
+   ip address %s
+
+interface Loopback1
+   description VTEP
+   ip address %s
+   ip address %s secondary
+
+"""
+
+bgp_template = """router bgp %s
+   router-id %s
+   distance bgp 20 200 200
+   maximum-paths 64 ecmp 64
+   neighbor spines peer-group
+   neighbor spines send-community
+   neighbor spines remote-as %s
+"""
+
+bgp_spine_template = """   neighbor %s peer-group spines
+"""
+
+bgp_peer_template = """   neighbor %s remote-as %s
+   neighbor %s next-hop-self
+   neighbor %s send-community
+   network %s
+   network %s
+   network %s
+
+"""
 
 # Start of Configuration Output
+mark_phase('inventory')
+fabric_spines, fabric_table = get_fabric_table(spine_plan)
 node_info = get_net_element(cvp_vars.getValue(cvp_names.CVP_MAC))
 hostname = node_info['fqdn'].split('.')[0]
-routed_info = get_routed_info(routed_ints)
-
+mark_phase('discovery')
 num = int(hostname[-1])
-mlag_ip = mlag_subnet[2] if num % 2 == 0 else mlag_subnet[1]
-mlag_peer = mlag_subnet[1] if num % 2 == 0 else mlag_subnet[2]
-
-print ''
-print 'ip routing'
-print ''
-print 'no spanning-tree vlan 4094'
-print ''
-print 'vlan 4094'
-print '   name MLAG_PEERLINK'
-print '   trunk group mlagpeer'
-print ''
-print 'interface Vlan4094'
-print '   description MLAG_SVI'
-print '   ip address %s/%s' % (mlag_ip, mlag_subnet.prefixlen)
-print ''
+mlag_first = num % 2 == 1
+stale = None
+pair = load_pair(mac)
+try:
+  if pair:
+    routed_info = pair['facts']
+    mlag_first = pair['mlag_first']
+  elif pair_dir:
+    routed_info, peer_mac, peer_info = get_pair_routed_info(routed_ints)
+    save_pair(peer_mac, peer_info, not mlag_first)
+  else:
+    routed_info = get_routed_info(routed_ints)
+  save_facts(mac, routed_info)
+except (DeviceUnavailable, socket.error, IOError), e:
+  saved = load_facts(mac)
+  if saved is None:
+    raise
+  stale = (e, time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(saved[0])))
+  routed_info = saved[1]
+mark_phase('render')
+
+mlag_ip = mlag_subnet[1] if mlag_first else mlag_subnet[2]
+mlag_peer = mlag_subnet[2] if mlag_first else mlag_subnet[1]
+
+config = list()
+if stale:
+  config.append(stale_template % stale)
+config.append(mlag_vlan_template % (mlag_ip, mlag_subnet.prefixlen))
 
 for _int in mlag_peer_ints:
-  print 'interface %s' % _int
-  print '   switchport mode trunk'
-  print '   channel-group 10 mode active'
-  print ''
+  config.append(peer_int_template % _int)
 
 for _int in mlag_ints:
   num = _int[-1]
-  print 'interface %s' % _int
-  print '   channel-group %s mode active' % num
-  print ''
+  config.append(mlag_int_template % (_int, num))
 for _int in mlag_ints:
   num = _int[-1]
-  print 'interface Port-Channel%s' % num
-  print '   switchport mode trunk'
-  print '   mlag %s' % num
-  print ''
-
-  
-print 'interface Port-Channe10'
-print '   description MLAG-PEERLINK'
-print '   switchport mode trunk'
-print '   switchport trunk group mlagpeer'
-print ''
-print 'mlag configuration'
-print '   domain-id mlagDomain'
-print '   local-interface Vlan4094'
-print '   peer-address %s' % mlag_peer
-print '   peer-link Port-Channel10'
-print ''
+  config.append(mlag_po_template % (num, num))
+
+config.append(mlag_config_template % mlag_peer)
 
 for item in routed_info:
-  print 'interface %s' % item['localInt']
-  print '   description %s_%s' % (item['systemName'], item['neighInt'])
-  print '   no switchport'
-  print '   ip address %s/%s' % (item['localIp'], item['cidr'])
-  print ''
-  
-print 'interface Loopback0'
-print '   ip address %s' % lo0
-print ''
-print 'interface Loopback1'
-print '   description VTEP'
-print '   ip address %s' % lo1
-print '   ip address %s secondary' % lo1_sec
-print ''
-
-print 'router bgp %s' % leaf_asn
-print '   router-id %s' % lo0[0]
-print '   distance bgp 20 200 200'
-print '   maximum-paths 64 ecmp 64'
-print '   neighbor spines peer-group'
-print '   neighbor spines send-community'
-print '   neighbor spines remote-as %s' % spine_asn
+  config.append(routed_int_template % (item['localInt'], item['systemName'],
+                item['neighInt'], item['localIp'], item['cidr']))
+
+config.append(loopback_template % (lo0, lo1, lo1_sec))
+
+config.append(bgp_template % (leaf_asn, lo0[0], spine_asn))
 for item in routed_info:
-  print '   neighbor %s peer-group spines' % item['neighIp']
-print '   neighbor %s remote-as %s' % (mlag_peer, leaf_asn)
-print '   neighbor %s next-hop-self' % mlag_peer
-print '   neighbor %s send-community' % mlag_peer
-print '   network %s' % lo0
-print '   network %s' % lo1
-print '   network %s' % lo1_sec
-print ''
\ No newline at end of file
+  config.append(bgp_spine_template % item['neighIp'])
+config.append(bgp_peer_template % (mlag_peer, leaf_asn, mlag_peer, mlag_peer, lo0, lo1, lo1_sec))
+
+mark_phase(None)
+if metrics_enabled:
+    config.append(write_metrics(hostname))
+sys.stdout.write(''.join(config))
+save_inventory()
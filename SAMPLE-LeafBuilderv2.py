@@ -11,10 +11,55 @@ from cvplibrary import Form
 from cvplibrary import RestClient
 
 import socket
-import jsonrpclib
+import array
+import threading
+import sys
+import time
+import random
+import os
+import bisect
 import json
+import re
 
-def get_credentials(ztp=GV.getValue(GVN.ZTP_STATE)):
+# Fabric p2p plan, spine hostname -> (supernet Form value, interfaces) of its SpineBuilder
+# or (supernet, interface -> spine address) for spines that allocate from a ledger
+# Uplink addresses on spines in the plan are derived without querying the spine
+# Spines missing from the plan are queried over eAPI instead
+# Can be changed to fit environment
+p2p_cidr = 31
+spine_plan = dict()
+#spine_plan['spine1'] = ('10.0.0.0/24', ['Ethernet%s' % n for n in range(1, 33)])
+
+# fabric_build.py hands over the plan of the spines it built in SPINE_PLAN_FILE
+if os.environ.get('SPINE_PLAN_FILE'):
+  with open(os.environ['SPINE_PLAN_FILE']) as f:
+    spine_plan.update(json.load(f))
+
+# How LLDP neighbors are read, only the neighbors on routed_ints are kept
+#  'full'    one 'show lldp neighbors detail' parsed in full
+#  'scoped'  one 'show lldp neighbors <interface> detail' per interface, in one request
+#  'stream'  one 'show lldp neighbors detail', only the needed interfaces are decoded
+# Can be changed to fit environment
+lldp_mode = 'full'
+
+# Spines are queried in parallel, set to 1 to query them one at a time
+# Can be changed to fit environment
+discovery_workers = 4
+
+# DNS lookups go through dns_resolver, time out after dns_timeout seconds and
+# are cached for dns_ttl seconds. dns_hosts_file preloads the cache from a
+# hosts file ("address name [alias ...]" per line) instead of asking DNS
+# Can be changed to fit environment
+dns_resolver = socket
+dns_timeout = 5
+dns_ttl = 300
+dns_hosts_file = None
+dns_cache = dict()
+
+# ZTP_STATE is read when credentials are first needed, not when the builder loads
+def get_credentials(ztp=None):
+  if ztp is None:
+    ztp = GV.getValue(GVN.ZTP_STATE)
   if ztp == 'true':
     user = GV.getValue(GVN.ZTP_USERNAME)
     pwd = GV.getValue(GVN.ZTP_PASSWORD)
@@ -23,60 +68,506 @@ def get_credentials(ztp=GV.getValue(GVN.ZTP_STATE)):
     pwd = GV.getValue(GVN.CVP_PASSWORD)
   return (user, pwd)
 
+# CVP inventory entries are looked up by MAC, IP or fqdn. With inventory_dir
+# set they are kept there in one snapshot shared by the builds and read from
+# it while younger than inventory_ttl seconds. Devices missing from it or
+# older than that are fetched one by one and written back together once the
+# build is done, so a build takes the snapshot lock at most once.
+# fabric_crawl.py --inventory-dir fills it with the whole inventory at once.
+# None disables the snapshot, every device is then fetched one by one
+# Can be changed to fit environment
+inventory_dir = None
+inventory_ttl = 3600
+inventory = None
+inventory_fetched = dict()
+inventory_lock = threading.Lock()
+
+def get_cvp(url):
+  client = TimedRestClient(url, 'GET')
+  call_device('cvp %s' % url.split('?')[0], client.connect)
+  return json.loads(client.getResponse())
+
+# Returns the snapshot in inventory_dir, MAC -> [time fetched, entry]
+def read_inventory():
+  if not inventory_dir:
+    return dict()
+  try:
+    with open(os.path.join(inventory_dir, 'inventory.json')) as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return dict()
+
+# Adds the entries fetched by this build to the snapshot, read again first as
+# other builds may have added to it meanwhile
+def save_inventory():
+  if not inventory_dir or not inventory_fetched:
+    return
+  path = os.path.join(inventory_dir, 'inventory.json')
+  while not take_lock(path + '.lock'):
+    wait_for('inventory')
+  try:
+    snapshot = read_inventory()
+    snapshot.update(inventory_fetched)
+    with open(path + '.tmp', 'w') as f:
+      json.dump(snapshot, f)
+    os.rename(path + '.tmp', path)
+  finally:
+    os.remove(path + '.lock')
+
+def add_net_element(index, fetched, node):
+  # Inventory pages may return ztpMode as a boolean
+  node['ztpMode'] = str(node['ztpMode']).lower()
+  for key in (('mac', node['systemMacAddress']), ('ip', node['ipAddress']), ('fqdn', node['fqdn'])):
+    index[key] = (fetched, node)
+
+# Returns the inventory entry whose field ('mac', 'ip' or 'fqdn') matches value
+# or None if it is not in the snapshot or is older than inventory_ttl
+def find_net_element(field, value):
+  global inventory
+  with inventory_lock:
+    if inventory is None:
+      inventory = dict()
+      for fetched, node in read_inventory().values():
+        add_net_element(inventory, fetched, node)
+    entry = inventory.get((field, value))
+  if entry is None or time.time() - entry[0] > inventory_ttl:
+    return None
+  return entry[1]
+
 def get_net_element(system_mac):
-  url='http://localhost:8080/cvpservice/provisioning/getNetElementById.do?netElementId={0}'.format(system_mac)
-  client = RestClient(url, 'GET')
-  client.connect()
-  node_info = json.loads(client.getResponse())
+  node_info = find_net_element('mac', system_mac)
+  if node_info is None:
+    url='http://localhost:8080/cvpservice/provisioning/getNetElementById.do?netElementId={0}'.format(system_mac)
+    node_info = coalesce('cvp', url, get_cvp, url)
+    fetched = time.time()
+    with inventory_lock:
+      add_net_element(inventory, fetched, node_info)
+      inventory_fetched[system_mac] = [fetched, node_info]
   return node_info
 
+# Calls to devices and CVP share a latency budget of build_budget seconds
+# Each call times out after call_timeout seconds. Calls that time out or fail
+# to connect are retried up to call_retries times with a jittered backoff
+# while the budget lasts, other errors are raised at once. A device that
+# fails breaker_threshold calls in a row is not called again
+# Shared with the other eAPI builders, check_shared.py keeps the copies identical
+# Can be changed to fit environment
+build_budget = 60
+call_timeout = 10
+call_retries = 2
+retry_backoff = 0.5
+breaker_threshold = 3
+build_deadline = time.time() + build_budget
+breaker = dict()
+breaker_lock = threading.Lock()
+
+class DeviceUnavailable(Exception):
+  pass
+
+# Errors worth a retry, the call timed out or the connection failed. HTTP
+# errors such as a 404 from CVP carry a code and are not retried
+def is_transient(e):
+  if isinstance(e, DeviceUnavailable):
+    return True
+  return isinstance(e, (socket.error, IOError)) and not hasattr(e, 'code')
+
+# Runs func(*args) in a separate thread and gives up after timeout seconds
+def call_with_timeout(func, args, timeout):
+  result = list()
+  def call():
+    try:
+      result.append((True, func(*args)))
+    except Exception:
+      result.append((False, sys.exc_info()))
+  thread = threading.Thread(target=call)
+  thread.daemon = True
+  thread.start()
+  thread.join(timeout)
+  if not result:
+    raise DeviceUnavailable('call timed out after %.1fs' % timeout)
+  if not result[0][0]:
+    error = result[0][1]
+    raise error[0], error[1], error[2]
+  return result[0][1]
+
+# Runs func(*args) on device with call_timeout and retries inside the budget
+def call_device(device, func, *args):
+  attempt = 0
+  while True:
+    with breaker_lock:
+      failures = breaker.get(device, 0)
+    if failures >= breaker_threshold:
+      raise DeviceUnavailable('%s failed %s calls in a row' % (device, failures))
+    remaining = build_deadline - time.time()
+    if remaining <= 0:
+      raise DeviceUnavailable('build budget of %ss used up before calling %s' % (build_budget, device))
+    try:
+      result = call_with_timeout(func, args, min(call_timeout, remaining))
+    except Exception, e:
+      if not is_transient(e):
+        raise
+      with breaker_lock:
+        breaker[device] = breaker.get(device, 0) + 1
+      attempt += 1
+      if attempt > call_retries:
+        raise DeviceUnavailable('%s: %s' % (device, e))
+      delay = retry_backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+      time.sleep(max(0, min(delay, build_deadline - time.time())))
+      continue
+    with breaker_lock:
+      breaker[device] = 0
+    return result
+
+# Builders running at the same time can share their calls through
+# coalesce_dir. The first builder to make a call runs it and leaves the result
+# there for coalesce_ttl seconds, builders making the same call meanwhile wait
+# for that result instead of calling again. At most coalesce_limit calls run
+# against one device at a time. Spines are then asked for all of their
+# interface addresses at once, so leaves asking for different ports share a
+# call. Results are removed once expired. None disables it
+# Can be changed to fit environment
+coalesce_dir = None
+coalesce_ttl = 5
+coalesce_limit = 2
+coalesce_poll = 0.05
+
+# Creates the lock file at path, or removes it and returns False if it was
+# left behind by a builder that stopped before the end of its budget
+def take_lock(path):
+  try:
+    os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    return True
+  except OSError:
+    try:
+      if time.time() - os.path.getmtime(path) > build_budget:
+        os.remove(path)
+    except OSError:
+      pass
+    return False
+
+def wait_for(device):
+  if time.time() > build_deadline:
+    raise DeviceUnavailable('build budget of %ss used up waiting for %s' % (build_budget, device))
+  time.sleep(coalesce_poll)
+
+# Removes the results older than coalesce_ttl, which no builder reads again
+def prune_results():
+  for name in os.listdir(coalesce_dir):
+    path = os.path.join(coalesce_dir, name)
+    if len(name) != 40 or '.' in name:
+      continue
+    try:
+      if time.time() - os.path.getmtime(path) > coalesce_ttl:
+        os.remove(path)
+    except OSError:
+      pass
+
+# Returns func(*args) for the call named by device and key, from the builder
+# running the same call when there is one
+def coalesce(device, key, func, *args):
+  if not coalesce_dir:
+    return func(*args)
+  import hashlib
+  path = os.path.join(coalesce_dir, hashlib.sha1(json.dumps([device, key])).hexdigest())
+  while True:
+    try:
+      if time.time() - os.path.getmtime(path) < coalesce_ttl:
+        with open(path) as f:
+          return json.load(f)
+    except (OSError, IOError):
+      pass
+    if take_lock(path + '.lock'):
+      break
+    wait_for(device)
+
+  try:
+    slots = [os.path.join(coalesce_dir, '%s.%s' % (device.replace(':', '_'), n)) for n in range(coalesce_limit)]
+    slot = None
+    while slot is None:
+      slot = next((slot for slot in slots if take_lock(slot)), None)
+      if slot is None:
+        wait_for(device)
+    try:
+      result = func(*args)
+    finally:
+      os.remove(slot)
+    prune_results()
+    with open(path + '.tmp', 'w') as f:
+      json.dump(result, f)
+    os.rename(path + '.tmp', path)
+    return result
+  finally:
+    os.remove(path + '.lock')
+
+# 'show ip interface <port>' is sent as 'show ip interface' when calls are
+# coalesced, pick_output takes the port back out of its output
+def shared_command(command):
+  if coalesce_dir and command.startswith('show ip interface '):
+    return 'show ip interface'
+  return command
+
+def pick_output(command, output):
+  if shared_command(command) == command:
+    return output
+  port = command[len('show ip interface '):]
+  return {'interfaces': {port: output['interfaces'][port]}}
+
+# eAPI connections are pooled per device and kept open between calls
+# jsonrpclib is only imported when the first connection is opened
+# eapi_pool_size limits the idle connections kept for each device
+# Can be changed to fit environment
+eapi_pool_size = 4
+eapi_pool = dict()
+eapi_pool_lock = threading.Lock()
+
 def send_command(user, pwd, ip, commands):
-  url = "https://%s:%s@%s/command-api" % (user, pwd, ip)
-  sw = jsonrpclib.Server(url)
+  return coalesce(ip, commands, call_device, ip, run_commands, user, pwd, ip, commands)
+
+def run_commands(user, pwd, ip, commands):
+  key = (user, pwd, ip)
+  with eapi_pool_lock:
+    idle = eapi_pool.setdefault(key, list())
+    sw = idle.pop() if idle else None
+  if sw is None:
+    url = "https://%s:%s@%s/command-api" % (user, pwd, ip)
+    import jsonrpclib
+    sw = jsonrpclib.Server(url)
   result = sw.runCmds(1, commands)
+  with eapi_pool_lock:
+    if len(eapi_pool[key]) < eapi_pool_size:
+      eapi_pool[key].append(sw)
   return result
 
-def get_leaf_routed_ips(routed_ints):
-  user, pwd = get_credentials()
-  sw_ip = GV.getValue(GVN.CVP_IP)
+# Runs one command and returns the raw eAPI response text, without parsing it
+def fetch_command(user, pwd, ip, command):
+  import urllib2
+  import base64
+  url = "https://%s/command-api" % ip
+  body = json.dumps({'jsonrpc': '2.0', 'method': 'runCmds', 'id': 1,
+                     'params': {'version': 1, 'cmds': [command]}})
+  request = urllib2.Request(url, body, {'Content-Type': 'application/json'})
+  request.add_header('Authorization', 'Basic %s' % base64.b64encode('%s:%s' % (user, pwd)))
+  return urllib2.urlopen(request).read()
+
+# Decodes the entries of the given keys from the JSON object named name in text
+# Only those entries are parsed, the rest of the text is skipped over
+def extract_entries(text, name, keys):
+  decoder = json.JSONDecoder()
+  start = text.find('"%s"' % name)
+  if start < 0:
+    raise ValueError('no %s in response: %s' % (name, text[:200]))
+  entries = dict()
+  for key in keys:
+    match = re.compile(r'"%s"\s*:\s*' % re.escape(key)).search(text, start)
+    if match:
+      entries[key] = decoder.raw_decode(text, match.end())[0]
+  return entries
+
+# Returns the LLDP neighbors of the switch at ip on interfaces, read as set by lldp_mode
+def get_lldp_info(user, pwd, ip, interfaces):
+  if lldp_mode == 'scoped':
+    commands = ['show lldp neighbors %s detail' % rint for rint in interfaces]
+    lldp_info = dict()
+    for result in send_command(user, pwd, ip, commands):
+      lldp_info.update(result['lldpNeighbors'])
+    return lldp_info
+  if lldp_mode == 'stream':
+    text = call_device(ip, fetch_command, user, pwd, ip, 'show lldp neighbors detail')
+    return extract_entries(text, 'lldpNeighbors', interfaces)
+  return send_command(user, pwd, ip, ['show lldp neighbors detail'])[0]['lldpNeighbors']
+
+# IPv4 addresses are handled as plain ints
+def ip_to_int(text):
+  octets = [int(octet) for octet in text.split('.')]
+  if len(octets) != 4 or [octet for octet in octets if not 0 <= octet <= 255]:
+    raise ValueError('invalid IPv4 address %s' % text)
+  return (octets[0] << 24) | (octets[1] << 16) | (octets[2] << 8) | octets[3]
+
+def int_to_ip(value):
+  return '%s.%s.%s.%s' % (value >> 24, (value >> 16) & 255, (value >> 8) & 255, value & 255)
+
+# Builds the p2p addressing table for every spine in spine_plan
+# Matches get_p2p_table in SpineBuilder, p2p_cidr subnets of the supernet are
+# assigned to the sorted interfaces in order and the spine takes the first address
+# Spines planned with their addresses keep the addresses they were given
+# Returns hostname -> (offset, interface -> index) and one array of spine addresses
+def get_fabric_table(plan):
+  spines = dict()
+  table = array.array('I')
+  for name in sorted(plan.keys()):
+    network, prefixlen = plan[name][0].split('/')
+    network = ip_to_int(network) & ~(2 ** (32 - int(prefixlen)) - 1)
+    addresses = plan[name][1] if isinstance(plan[name][1], dict) else dict()
+    ports = dict()
+    for index, intf in enumerate(sorted(plan[name][1])):
+      first = network + index * 2 ** (32 - p2p_cidr)
+      ports[intf] = index
+      if intf in addresses:
+        table.append(ip_to_int(addresses[intf]))
+      else:
+        table.append(first if p2p_cidr == 31 else first + 1)
+    spines[name] = (len(table) - len(ports), ports)
+  return spines, table
+
+# Returns the (spine, leaf) addresses of a spine interface from the fabric table
+# or None if the spine or interface is not part of the plan
+def get_plan_ips(hostname, intf):
+  if hostname not in fabric_spines or intf not in fabric_spines[hostname][1]:
+    return None
+  offset, ports = fabric_spines[hostname]
+  spine_ip = fabric_table[offset + ports[intf]]
+  return (int_to_ip(spine_ip), int_to_ip(spine_ip + 1))
+
+# Runs func on each item, discovery_workers items at a time in parallel threads
+# Results are returned in the same order as items
+def run_parallel(func, items):
+  items = list(items)
+  if discovery_workers <= 1:
+    return [func(item) for item in items]
+  
+  results = [None] * len(items)
+  pending = list(enumerate(items))
+  errors = list()
+  lock = threading.Lock()
+  
+  def worker():
+    while True:
+      with lock:
+        if not pending or errors:
+          return
+        index, item = pending.pop(0)
+      try:
+        results[index] = func(item)
+      except Exception:
+        with lock:
+          errors.append(sys.exc_info())
+  
+  threads = [threading.Thread(target=worker) for _ in range(min(discovery_workers, len(items)))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  if errors:
+    raise errors[0][0], errors[0][1], errors[0][2]
+  return results
+
+# Sends the commands of many requests with one runCmds per device
+# requests is a list of (user, pwd, ip, commands) and commands repeated for the
+# same device are only run once. Returns the results of each request in order
+def send_batch(requests):
+  devices = dict()
+  for user, pwd, ip, commands in requests:
+    key = (user, pwd, ip)
+    if key not in devices:
+      devices[key] = dict()
+    for command in commands:
+      devices[key].setdefault(shared_command(command), len(devices[key]))
+  
+  keys = devices.keys()
+  outputs = run_parallel(lambda key: send_command(key[0], key[1], key[2],
+                         sorted(devices[key], key=devices[key].get)), keys)
+  outputs = dict(zip(keys, outputs))
+  
+  results = list()
+  for user, pwd, ip, commands in requests:
+    key = (user, pwd, ip)
+    results.append([pick_output(command, outputs[key][devices[key][shared_command(command)]])
+                    for command in commands])
+  return results
+
+# Fills in the addresses of ports on one spine that are in the fabric plan
+# Returns the eAPI request for the remaining ports or None if there are none
+def get_spine_request(device, ports):
   commands = list()
-  commands.append('show lldp neighbors detail')
+  for intf in ports.keys():
+    if 'spine_mac' != intf and not ports[intf]['spine_ip']:
+      plan_ips = get_plan_ips(device, intf)
+      if plan_ips:
+        ports[intf]['spine_ip'] = plan_ips[0]
+        ports[intf]['leaf_ip'] = plan_ips[1]
+      else:
+        commands.append('show ip interface {0}'.format(intf))
+  if not commands:
+    return None
   
-  lldp_info = send_command(user, pwd, sw_ip, commands)[0]['lldpNeighbors']
+  node = get_net_element(ports['spine_mac'])
+  _user, _pwd = get_credentials(node['ztpMode'])
+  return (_user, _pwd, node['ipAddress'], commands)
+
+# Uplinks can be looked up in a topology index written by fabric_crawl.py
+# instead of being discovered. Leaves missing from the index, or an index
+# older than topology_ttl seconds, fall back to discovery. None disables it
+# Can be changed to fit environment
+topology_index = None
+topology_ttl = 3600
+topology = dict()
+
+def load_topology():
+  if not topology and topology_index and os.path.exists(topology_index):
+    with open(topology_index) as f:
+      index = json.load(f)
+    if time.time() - index['time'] < topology_ttl:
+      topology.update(index)
+  return topology
+
+# Devices the crawler could not reach keep their entries in the index, they
+# are used for topology_ttl seconds after they were last crawled
+def is_crawled(index, device):
+  entry = index['devices'].get(device)
+  return bool(entry) and time.time() - entry.get('time', index['time']) < topology_ttl
+
+# Returns (interface, spine name, spine mac, spine port, spine ip) for each of
+# routed_ints from the topology index, or None if any is missing
+def get_indexed_links(system_mac, routed_ints):
+  index = load_topology()
+  if not index or not is_crawled(index, system_mac):
+    return None
+  links = list()
+  for rint in routed_ints:
+    link = index['links'].get('%s %s' % (system_mac, rint))
+    address = index['addresses'].get('%s %s' % tuple(link)) if link else None
+    if not address or not is_crawled(index, link[0]):
+      return None
+    links.append((rint, index['devices'][link[0]]['hostname'], link[0], link[1], address[0]))
+  return links
+
+def get_leaf_routed_ips(routed_ints):
+  links = get_indexed_links(GV.getValue(GVN.CVP_MAC), routed_ints)
+  if links is None:
+    user, pwd = get_credentials()
+    sw_ip = GV.getValue(GVN.CVP_IP)
+    lldp_info = get_lldp_info(user, pwd, sw_ip, routed_ints)
+    links = list()
+    for rint in routed_ints:
+      sw_name = lldp_info[rint]['lldpNeighborInfo'][0]['systemName'].split('.')[0]
+      sw_mac = lldp_info[rint]['lldpNeighborInfo'][0]['chassisId'].replace('.','')
+      sw_mac = ':'.join(a+b for a,b in zip(sw_mac[::2], sw_mac[1::2]))
+      port = lldp_info[rint]['lldpNeighborInfo'][0]['neighborInterfaceInfo']['interfaceId'].replace('"','')
+      links.append((rint, sw_name, sw_mac, port, ''))
   
   neighbors = dict()
-  for rint in routed_ints:
-    sw_name = lldp_info[rint]['lldpNeighborInfo'][0]['systemName'].split('.')[0]
-    sw_mac = lldp_info[rint]['lldpNeighborInfo'][0]['chassisId'].replace('.','')
-    sw_mac = ':'.join(a+b for a,b in zip(sw_mac[::2], sw_mac[1::2]))
+  for rint, sw_name, sw_mac, port, spine_ip in links:
     if sw_name not in neighbors.keys():
       neighbors[sw_name] = dict()
-    port = lldp_info[rint]['lldpNeighborInfo'][0]['neighborInterfaceInfo']['interfaceId'].replace('"','')
     if port not in neighbors[sw_name].keys():
       neighbors[sw_name][port] = dict()
     neighbors[sw_name][port]['leaf_if'] = rint
-    neighbors[sw_name][port]['spine_ip'] = ''
-    neighbors[sw_name][port]['leaf_ip'] = ''
+    neighbors[sw_name][port]['spine_ip'] = spine_ip
+    neighbors[sw_name][port]['leaf_ip'] = int_to_ip(ip_to_int(spine_ip) + 1) if spine_ip else ''
     neighbors[sw_name]['spine_mac'] = sw_mac
   
-  for device in neighbors.keys():
-    commands = list()
-    for intf in neighbors[device].keys():
-      if 'spine_mac' != intf:
-        commands.append('show ip interface {0}'.format(intf))
-    
-    node = get_net_element(neighbors[device]['spine_mac'])
-    _user, _pwd = get_credentials(node['ztpMode'])
-    ip_info = send_command(_user, _pwd, node['ipAddress'], commands)
+  devices = neighbors.keys()
+  requests = run_parallel(lambda device: get_spine_request(device, neighbors[device]), devices)
+  queried = [(device, request) for device, request in zip(devices, requests) if request]
+  
+  results = send_batch([request for device, request in queried])
+  for (device, request), ip_info in zip(queried, results):
     for ip_intf in ip_info:
       intf = ip_intf['interfaces'].keys()[0]
       ip = ip_intf['interfaces'][intf]['interfaceAddress']['primaryIp']['address']
       neighbors[device][intf]['spine_ip'] = ip
-      octect = ip.split('.')
-      fourth = int(octect[3]) + 1
-      leaf_ip = '{0}.{1}.{2}.{3}'.format(octect[0], octect[1], octect[2], fourth)
-      neighbors[device][intf]['leaf_ip'] = leaf_ip
-    
+      neighbors[device][intf]['leaf_ip'] = int_to_ip(ip_to_int(ip) + 1)
+  
   routed_info = list()
   for device in neighbors.keys():
     for intf in neighbors[device].keys():
@@ -88,17 +579,199 @@ def get_leaf_routed_ips(routed_ints):
 
   return routed_info
 
-### Start of Script
-mgmt_ip = Form.getFieldById('mgmt_ip').getValue()
-bgp_as = Form.getFieldById('bgp_as').getValue()
-loop_1 = Form.getFieldById('loop_1').getValue()
-routed_ints = ['Ethernet2', 'Ethernet3']
-snmp_info = Form.getFieldById('snmp_info').getValue()
+# Loads a hosts file into the DNS cache, these entries never expire
+def load_hosts_file(path):
+  for line in open(path):
+    fields = line.split('#')[0].split()
+    if len(fields) < 2:
+      continue
+    dns_cache[('addr', fields[0])] = (fields[1], None)
+    for name in fields[1:]:
+      dns_cache[('name', name)] = (fields[0], None)
 
-# Build Managemennt Configuration
-mgmt_lookup = socket.gethostbyaddr(mgmt_ip)
-hostname = mgmt_lookup[0].split('.')[0]
-mgmt_config = '''
+# Returns the cached DNS answer for kind 'addr' (reverse) or 'name' (forward)
+# and resolves it through dns_resolver if missing or expired
+def resolve(kind, value):
+  entry = dns_cache.get((kind, value))
+  if entry and (entry[1] is None or entry[1] > time.time()):
+    return entry[0]
+  if kind == 'addr':
+    answer = call_with_timeout(dns_resolver.gethostbyaddr, (value,), dns_timeout)[0]
+  else:
+    answer = call_with_timeout(dns_resolver.gethostbyname, (value,), dns_timeout)
+  dns_cache[(kind, value)] = (answer, time.time() + dns_ttl)
+  return answer
+
+# Rendered sections are kept in section_cache_dir, one file per device, with
+# a fingerprint of the inputs each one was rendered from. A rebuild renders
+# only the sections whose inputs changed and reuses the rest
+# DNS answers are reused for facts_ttl seconds as long as the inputs they were
+# resolved from are unchanged. LLDP neighbors are discovered on every build,
+# as recabling changes them without changing any input, and the saved ones
+# are only used when discovery fails
+# None disables the cache
+# Can be changed to fit environment
+section_cache_dir = None
+facts_ttl = 3600
+section_cache = dict()
+
+def fingerprint(inputs):
+  import hashlib
+  return hashlib.sha1(json.dumps(inputs, sort_keys=True, default=str)).hexdigest()
+
+def load_section_cache(device):
+  section_cache.clear()
+  if not section_cache_dir:
+    return
+  try:
+    with open(os.path.join(section_cache_dir, '%s.json' % device)) as f:
+      section_cache.update(json.load(f))
+  except (IOError, ValueError):
+    pass
+
+# Written to a temporary file first so builds never read a partial cache
+def save_section_cache(device):
+  if not section_cache_dir:
+    return
+  path = os.path.join(section_cache_dir, '%s.json' % device)
+  with open(path + '.tmp', 'w') as f:
+    json.dump(section_cache, f)
+  os.rename(path + '.tmp', path)
+
+# Returns the cached text of section name if its inputs are unchanged,
+# otherwise renders it with render() and caches the result
+def render_section(name, inputs, render):
+  if not section_cache_dir:
+    return render()
+  key = fingerprint(inputs)
+  entry = section_cache.get(name)
+  if entry and entry['fingerprint'] == key:
+    return entry['text'].encode('utf-8')
+  text = render()
+  section_cache[name] = {'fingerprint': key, 'text': text}
+  return text
+
+# Returns the cached fact name if reuse is set, its inputs are unchanged and
+# it is younger than facts_ttl, otherwise discovers it again with discover()
+# If a device cannot be reached the cached fact is used anyway and listed in
+# stale_facts, any other error fails the build
+stale_facts = list()
+
+def get_fact(name, inputs, discover, reuse=True):
+  if not section_cache_dir:
+    return discover()
+  key = fingerprint(inputs)
+  entry = section_cache.get(name)
+  if reuse and entry and entry['fingerprint'] == key and time.time() - entry['time'] < facts_ttl:
+    return entry['value']
+  try:
+    value = discover()
+  except (DeviceUnavailable, socket.error, IOError), e:
+    if not entry or entry['fingerprint'] != key:
+      raise
+    stale_facts.append((name, e, entry['time']))
+    return entry['value']
+  section_cache[name] = {'fingerprint': key, 'value': value, 'time': time.time()}
+  return value
+
+# Build metrics, off by default
+# metrics_comment appends phase times, call latencies and peak memory to the
+# configlet as ! comments, metrics_file appends them to that file as JSON lines
+# Shared with the other builders, check_shared.py keeps the copies identical
+# Can be changed to fit environment
+metrics_comment = False
+metrics_file = None
+metrics_enabled = metrics_comment or bool(metrics_file)
+metrics_buckets = [0.005, 0.01, 0.05, 0.1, 0.5, 1, 5]
+metrics = {'phases': list(), 'phase': None, 'calls': dict()}
+metrics_lock = threading.Lock()
+
+# Ends the running phase and starts the next, None ends the last phase
+def mark_phase(name):
+  if not metrics_enabled:
+    return
+  now = time.time()
+  if metrics['phase']:
+    metrics['phases'].append((metrics['phase'][0], now - metrics['phase'][1]))
+  metrics['phase'] = (name, now) if name else None
+
+# Returns func with its calls timed under kind when metrics are enabled
+def instrument(kind, func):
+  if not metrics_enabled:
+    return func
+  def timed(*args, **kwargs):
+    start = time.time()
+    try:
+      return func(*args, **kwargs)
+    finally:
+      record_call(kind, time.time() - start)
+  return timed
+
+def record_call(kind, elapsed):
+  with metrics_lock:
+    if kind not in metrics['calls']:
+      metrics['calls'][kind] = {'count': 0, 'total': 0.0, 'max': 0.0,
+                                'histogram': [0] * (len(metrics_buckets) + 1)}
+    calls = metrics['calls'][kind]
+    calls['count'] += 1
+    calls['total'] += elapsed
+    calls['max'] = max(calls['max'], elapsed)
+    calls['histogram'][bisect.bisect_left(metrics_buckets, elapsed)] += 1
+
+def get_metrics_report(device):
+  report = dict()
+  report['builder'] = os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else None
+  report['device'] = device
+  report['time'] = time.time()
+  report['phases'] = metrics['phases']
+  report['calls'] = metrics['calls']
+  report['buckets'] = metrics_buckets
+  try:
+    import resource
+    report['peak_memory_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  except ImportError:
+    report['peak_memory_kb'] = None
+  return report
+
+def format_metrics(report):
+  lines = ['!! Builder metrics']
+  for name, elapsed in report['phases']:
+    lines.append('! phase %s: %.3fs' % (name, elapsed))
+  for kind in sorted(report['calls'].keys()):
+    calls = report['calls'][kind]
+    buckets = ['<=%sms:%s' % (int(limit * 1000), count)
+               for limit, count in zip(report['buckets'], calls['histogram'])]
+    buckets.append('>%sms:%s' % (int(report['buckets'][-1] * 1000), calls['histogram'][-1]))
+    lines.append('! %s calls: %s, total %.3fs, max %.3fs' % (kind, calls['count'], calls['total'], calls['max']))
+    lines.append('!   %s' % ' '.join(buckets))
+  lines.append('! peak memory: %s KB' % report['peak_memory_kb'])
+  return '\n'.join(lines) + '\n'
+
+def write_metrics(device):
+  report = get_metrics_report(device)
+  if metrics_file:
+    import json
+    with metrics_lock:
+      with open(metrics_file, 'a') as f:
+        f.write(json.dumps(report) + '\n')
+  return format_metrics(report) if metrics_comment else ''
+
+# RestClient whose connect is timed as a 'rest' call when metrics are enabled
+class TimedRestClient(object):
+  def __init__(self, url, method):
+    self.client = RestClient(url, method)
+    self.connect = instrument('rest', self.client.connect)
+    self.getResponse = self.client.getResponse
+
+send_command = instrument('eapi', send_command)
+fetch_command = instrument('eapi', fetch_command)
+
+### Configuration templates
+# Each configlet is rendered into one buffer and written out once
+stale_template = '''
+! {0} discovered at {2} used, discovery failed: {1}'''
+
+mgmt_template = '''
 hostname {0}
 
 vrf definition mgmt
@@ -114,17 +787,9 @@ management api http-commands
    vrf mgmt
       no shutdown
 
-'''.format(hostname, mgmt_ip)
+'''
 
-# Build MLAG configuration
-if list(hostname)[-1] == "1":
-  mlag_ip = '192.168.0.1'
-  mlag_peer = '192.168.0.2'
-else:
-  mlag_ip = '192.168.0.2'
-  mlag_peer = '192.168.0.1'
-
-mlag_config = '''
+mlag_template = '''
 vlan 4094
    name mlag-peer-link
    trunk group mlagpeer
@@ -155,32 +820,25 @@ mlag configuration
    peer-link Port-Channel100
    reload-delay mlag 360
    reload-delay non-mlag 300
-'''.format(mlag_ip, mlag_peer)
+'''
 
-#Build Loopback Configuration
-loop_0 = socket.gethostbyname('{0}'.format(hostname)).strip()
-loopback_config = '''
+loopback_template = '''
 interface Loopback0
    ip address {0}/32
 
 interface Loopback1
    ip address {1}/32
 
-'''.format(loop_0, loop_1)
+'''
 
-# Build Routed Ethernet Configuration
-routed_info = get_leaf_routed_ips(routed_ints)
-ethernet_config = ''
-for item in routed_info:
-  ethernet_config += '''
+ethernet_template = '''
 interface {0}
    description {1}-{2}
    no switchport
    ip address {3}/31
-'''.format(item[0], item[1], item[2], item[3])
+'''
 
-#Build BGP Configuration
-bgp_config = '''
+bgp_template = '''
 ip routing
 
 router bgp {1}
@@ -195,21 +853,86 @@ router bgp {1}
    neighbor {2} remote-as {1}
    neighbor {2} next-hop-self
    neighbor {2} send-community
-   neighbor {2} maximum-routes 0'''.format(loop_0, bgp_as, mlag_peer)
-   
-for item in routed_info:
-  bgp_config += '''
+   neighbor {2} maximum-routes 0'''
+
+bgp_spine_template = '''
    neighbor {0} peer-group spines
-   neighbor {0} description {1} '''.format(item[4], item[1])
-bgp_config += '''
+   neighbor {0} description {1} '''
+
+bgp_redistribute_template = '''
    redistribute connected
    redistribute static
    redistribute attached-host
 
-'''.format(bgp_as)
+'''
+
+### Start of Script
+mark_phase('dns')
+if dns_hosts_file:
+  load_hosts_file(dns_hosts_file)
+
+fabric_spines, fabric_table = get_fabric_table(spine_plan)
+mgmt_ip = Form.getFieldById('mgmt_ip').getValue()
+bgp_as = Form.getFieldById('bgp_as').getValue()
+loop_1 = Form.getFieldById('loop_1').getValue()
+routed_ints = ['Ethernet2', 'Ethernet3']
+snmp_info = Form.getFieldById('snmp_info').getValue()
+
+# Build Managemennt Configuration
+system_mac = GV.getValue(GVN.CVP_MAC)
+load_section_cache(system_mac)
+hostname = get_fact('hostname', ['addr', mgmt_ip],
+                    lambda: resolve('addr', mgmt_ip).split('.')[0])
+mgmt_config = render_section('mgmt', [mgmt_template, hostname, mgmt_ip],
+                             lambda: mgmt_template.format(hostname, mgmt_ip))
+
+# Build MLAG configuration
+if list(hostname)[-1] == "1":
+  mlag_ip = '192.168.0.1'
+  mlag_peer = '192.168.0.2'
+else:
+  mlag_ip = '192.168.0.2'
+  mlag_peer = '192.168.0.1'
+
+mlag_config = render_section('mlag', [mlag_template, mlag_ip, mlag_peer],
+                             lambda: mlag_template.format(mlag_ip, mlag_peer))
+
+#Build Loopback Configuration
+loop_0 = get_fact('loop_0', ['name', hostname], lambda: resolve('name', hostname).strip())
+loopback_config = render_section('loopback', [loopback_template, loop_0, loop_1],
+                                 lambda: loopback_template.format(loop_0, loop_1))
+
+# Build Routed Ethernet Configuration
+mark_phase('discovery')
+routed_info = get_fact('routed_info', [GV.getValue(GVN.CVP_IP), routed_ints, spine_plan, p2p_cidr],
+                       lambda: get_leaf_routed_ips(routed_ints), reuse=False)
+mark_phase('render')
+ethernet_config = render_section('ethernet', [ethernet_template, routed_info],
+                                 lambda: ''.join(ethernet_template.format(item[0], item[1], item[2], item[3])
+                                                 for item in routed_info))
+
+#Build BGP Configuration
+def render_bgp():
+  bgp_config = bgp_template.format(loop_0, bgp_as, mlag_peer)
+  bgp_config += ''.join(bgp_spine_template.format(item[4], item[1]) for item in routed_info)
+  bgp_config += bgp_redistribute_template
+  return bgp_config
+
+bgp_config = render_section('bgp', [bgp_template, bgp_spine_template, bgp_redistribute_template,
+                                    loop_0, bgp_as, mlag_peer, routed_info], render_bgp)
+save_section_cache(system_mac)
+save_inventory()
 
-print loopback_config
-print ethernet_config
-print mlag_config
-print bgp_config
-print mgmt_config
\ No newline at end of file
+config = [loopback_config, ethernet_config, mlag_config, bgp_config, mgmt_config]
+if stale_facts:
+  stale_config = '!! Stale facts'
+  for name, error, when in stale_facts:
+    when = time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(when))
+    stale_config += stale_template.format(name, error, when)
+  config.insert(0, stale_config)
+mark_phase(None)
+if metrics_enabled and metrics_comment:
+  config.append(write_metrics(hostname))
+elif metrics_enabled:
+  write_metrics(hostname)
+sys.stdout.write('\n'.join(config) + '\n')
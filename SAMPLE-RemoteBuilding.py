@@ -6,14 +6,74 @@
 # 4. Loopback0 will be used as the source for Monitoring, Telemetry, TACACS, etc
 
 #from cvplibrary import Form
-import netaddr
 import os
+import sys
+import time
+import threading
+
+# IPv4 addresses are handled as plain ints
+# IPv4Network covers the parts of netaddr.IPNetwork the builders use
+def ip_to_int(text):
+    octets = [int(octet) for octet in text.split('.')]
+    if len(octets) != 4 or [octet for octet in octets if not 0 <= octet <= 255]:
+        raise ValueError('invalid IPv4 address %s' % text)
+    return (octets[0] << 24) | (octets[1] << 16) | (octets[2] << 8) | octets[3]
+
+def int_to_ip(value):
+    return '%s.%s.%s.%s' % (value >> 24, (value >> 16) & 255, (value >> 8) & 255, value & 255)
+
+# str() keeps the address as given, like netaddr, while first, last, network
+# and indexing work on the masked network address
+class IPv4Network(object):
+    __slots__ = ('ip', 'prefixlen')
+
+    def __init__(self, ip, prefixlen=32):
+        if isinstance(ip, basestring):
+            if '/' in ip:
+                ip, prefixlen = ip.split('/')
+            ip = ip_to_int(ip)
+        prefixlen = int(prefixlen)
+        if not 0 <= prefixlen <= 32:
+            raise ValueError('invalid prefix length %s' % prefixlen)
+        self.ip = ip
+        self.prefixlen = prefixlen
+
+    @property
+    def size(self):
+        return 2 ** (32 - self.prefixlen)
+
+    @property
+    def first(self):
+        return self.ip & ~(self.size - 1)
+
+    @property
+    def last(self):
+        return self.first + self.size - 1
+
+    @property
+    def network(self):
+        return int_to_ip(self.first)
+
+    # Address at index from the network address, negative indexes count back
+    # from the broadcast address
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError('no address at index %s in %s' % (index, self))
+        return int_to_ip(self.first + index)
+
+    def __str__(self):
+        return '%s/%s' % (int_to_ip(self.ip), self.prefixlen)
+
+    def __repr__(self):
+        return 'IPv4Network(%r)' % str(self)
 
 # Set Variables based on Form
 hostname = Form.getFieldById('hostname').getValue().upper()
-base_net = netaddr.IPNetwork(Form.getFieldById('base_net').getValue())
+base_net = IPv4Network(Form.getFieldById('base_net').getValue())
 floors = int(Form.getFieldById('floors').getValue())
-wan_p2p = netaddr.IPNetwork(Form.getFieldById('wan_p2p').getValue())
+wan_p2p = IPv4Network(Form.getFieldById('wan_p2p').getValue())
 wan_intf = Form.getFieldById('wan_intf').getValue()
 peerlink = Form.getFieldById('peerlink').getValue()
 peerlink_ints = peerlink.split(',')
@@ -21,27 +81,309 @@ wan_as = Form.getFieldById('wan_as').getValue()
 local_as = Form.getFieldById('local_as').getValue()
 rp = Form.getFieldById('rp').getValue()
 dhcp_ip = Form.getFieldById('dhcp').getValue()
-
+# One of telemetry_profiles, standard if the Form has no such field or it is empty
+telemetry_field = Form.getFieldById('telemetry_profile')
+telemetry_profile = (telemetry_field.getValue() if telemetry_field else None) or 'standard'
+
+
+# Build metrics, off by default
+# metrics_comment appends phase times, call latencies and peak memory to the
+# configlet as ! comments, metrics_file appends them to that file as JSON lines
+# RemoteBuilding makes no eAPI or REST calls, only phases are timed
+# Shared with the other builders, check_shared.py keeps the copies identical
+# Can be changed to fit environment
+metrics_comment = False
+metrics_file = None
+metrics_enabled = metrics_comment or bool(metrics_file)
+metrics_buckets = [0.005, 0.01, 0.05, 0.1, 0.5, 1, 5]
+metrics = {'phases': list(), 'phase': None, 'calls': dict()}
+metrics_lock = threading.Lock()
+
+# Ends the running phase and starts the next, None ends the last phase
+def mark_phase(name):
+    if not metrics_enabled:
+        return
+    now = time.time()
+    if metrics['phase']:
+        metrics['phases'].append((metrics['phase'][0], now - metrics['phase'][1]))
+    metrics['phase'] = (name, now) if name else None
+
+def get_metrics_report(device):
+    report = dict()
+    report['builder'] = os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else None
+    report['device'] = device
+    report['time'] = time.time()
+    report['phases'] = metrics['phases']
+    report['calls'] = metrics['calls']
+    report['buckets'] = metrics_buckets
+    try:
+        import resource
+        report['peak_memory_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        report['peak_memory_kb'] = None
+    return report
+
+def format_metrics(report):
+    lines = ['!! Builder metrics']
+    for name, elapsed in report['phases']:
+        lines.append('! phase %s: %.3fs' % (name, elapsed))
+    for kind in sorted(report['calls'].keys()):
+        calls = report['calls'][kind]
+        buckets = ['<=%sms:%s' % (int(limit * 1000), count)
+                   for limit, count in zip(report['buckets'], calls['histogram'])]
+        buckets.append('>%sms:%s' % (int(report['buckets'][-1] * 1000), calls['histogram'][-1]))
+        lines.append('! %s calls: %s, total %.3fs, max %.3fs' % (kind, calls['count'], calls['total'], calls['max']))
+        lines.append('!   %s' % ' '.join(buckets))
+    lines.append('! peak memory: %s KB' % report['peak_memory_kb'])
+    return '\n'.join(lines) + '\n'
+
+def write_metrics(device):
+    report = get_metrics_report(device)
+    if metrics_file:
+        import json
+        with metrics_lock:
+            with open(metrics_file, 'a') as f:
+                f.write(json.dumps(report) + '\n')
+    return format_metrics(report) if metrics_comment else ''
+
+
+# Rendered sections are kept in section_cache_dir, one file per device, with
+# a fingerprint of the inputs each one was rendered from. A rebuild renders
+# only the sections whose inputs changed and reuses the rest
+# None disables the cache
+# Can be changed to fit environment
+section_cache_dir = None
+section_cache = dict()
+
+def fingerprint(inputs):
+    import hashlib
+    import json
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True, default=str)).hexdigest()
+
+def load_section_cache(device):
+    section_cache.clear()
+    if not section_cache_dir:
+        return
+    import json
+    try:
+        with open(os.path.join(section_cache_dir, '%s.json' % device)) as f:
+            section_cache.update(json.load(f))
+    except (IOError, ValueError):
+        pass
+
+# Written to a temporary file first so builds never read a partial cache
+def save_section_cache(device):
+    if not section_cache_dir:
+        return
+    import json
+    path = os.path.join(section_cache_dir, '%s.json' % device)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(section_cache, f)
+    os.rename(path + '.tmp', path)
+
+# Returns the cached text of section name if its inputs are unchanged,
+# otherwise renders it with render() and caches the result
+def render_section(name, inputs, render):
+    if not section_cache_dir:
+        return render()
+    key = fingerprint(inputs)
+    entry = section_cache.get(name)
+    if entry and entry['fingerprint'] == key:
+        return entry['text'].encode('utf-8')
+    text = render()
+    section_cache[name] = {'fingerprint': key, 'text': text}
+    return text
+
+
+# Output is compacted when compact_output is set, VLAN lists are written as
+# ranges and settings shared by many interfaces are applied to interface ranges
+# Can be changed to fit environment
+compact_output = False
+
+# Collapses numbers into ranges, e.g. 101,102,103,470 -> 101-103,470
+def compress_numbers(numbers):
+    ranges = list()
+    for number in sorted(set(numbers)):
+        if ranges and ranges[-1][1] == number - 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ','.join('%s-%s' % (a, b) if a != b else str(a) for a, b in ranges)
+
+# Collapses interface names into one range per run of consecutive ports,
+# e.g. Ethernet1,Ethernet2,Ethernet3,Ethernet5 -> Ethernet1-3 and Ethernet5
+# Returns a list of ranges, each usable as "interface <range>"
+def compress_interfaces(names):
+    ports = set()
+    for name in names:
+        stem = name.rstrip('0123456789')
+        ports.add((stem, int(name[len(stem):]) if stem != name else None))
+    runs = list()
+    for stem, number in sorted(ports):
+        if number is not None and runs and runs[-1][0] == stem and runs[-1][2] == number - 1:
+            runs[-1][2] = number
+        else:
+            runs.append([stem, number, number])
+    ranges = list()
+    for stem, first, last in runs:
+        if first is None:
+            ranges.append(stem)
+        elif first == last:
+            ranges.append('%s%s' % (stem, first))
+        else:
+            ranges.append('%s%s-%s' % (stem, first, last))
+    return ranges
+
+
+# Functions to allocate subnets in address order from base_net
+# Every allocation is carved from the lowest free address, so the free space
+# is always a single run of addresses and only its start needs to be tracked
+def new_allocator(supernet, block):
+    allocator = dict()
+    allocator['next'] = supernet.first
+    allocator['last'] = supernet.last if supernet.prefixlen <= block else supernet.first - 1
+    # Free space starts out as separate subnets of size block and is only
+    # merged into larger subnets after the first one has been split
+    allocator['block'] = block
+    allocator['merged'] = False
+    return allocator
+
+# Returns the prefix length of the lowest free subnet
+def free_prefixlen(allocator):
+    if not allocator['merged']:
+        return allocator['block']
+    start = allocator['next']
+    remaining = allocator['last'] - start + 1
+    size = start & -start if start else 2 ** 32
+    while size > remaining:
+        size >>= 1
+    return 33 - size.bit_length()
 
 # Function to find next subnet based on cidr
-# returns updated subnets list and subnet
-def get_subnet(subnets, cidr):
-    found = False
-    while not found:
-        subnet = subnets.pop(0)
-        if cidr == subnet.prefixlen:
-            found = True
-        elif cidr < subnet.prefixlen:
+# Smaller free subnets in front of the next fit are skipped
+def get_subnet(allocator, cidr):
+    while allocator['next'] <= allocator['last']:
+        start = allocator['next']
+        prefixlen = free_prefixlen(allocator)
+        if cidr < prefixlen:
+            allocator['next'] += 2 ** (32 - prefixlen)
             continue
-        elif cidr > subnet.prefixlen:
-            new_subnets = sorted(list(subnet.subnet(cidr)))
-            subnet = new_subnets.pop(0)
-            found = True
-            subnets.extend(new_subnets)
-            subnets = sorted(list(netaddr.cidr_merge(subnets)))
-            
-    return subnets, subnet
-
+        elif cidr > prefixlen:
+            allocator['merged'] = True
+        allocator['next'] += 2 ** (32 - cidr)
+        return IPv4Network(start, cidr)
+
+    raise IndexError('no free /%s left in base_net' % cidr)
+
+# Returns the subnet at index in supernet.subnet(prefixlen) without listing them
+# Negative indexes count back from the end of supernet
+def get_nth_subnet(supernet, prefixlen, index):
+    count = 2 ** (prefixlen - supernet.prefixlen) if prefixlen >= supernet.prefixlen else 0
+    if index < 0:
+        index += count
+    if not 0 <= index < count:
+        raise IndexError('no /%s at index %s in %s' % (prefixlen, index, supernet))
+    start = supernet.first + index * 2 ** (32 - prefixlen)
+    return IPv4Network(start, prefixlen)
+
+# Allocations can be kept in an on-disk ledger in ipam_dir so that they stay
+# the same from build to build, whatever else changes in the Form. Each
+# supernet gets a memory-mapped bitmap with one bit per address and an index
+# of its assignments by key, both guarded by a file lock so that builders
+# running at the same time can share them. Needs mmap and fcntl, so it is
+# only available to offline builds, not in CVP. None disables the ledger
+# Shared with the other builders, check_shared.py keeps the copies identical
+# Can be changed to fit environment
+ipam_dir = None
+
+class Ledger(object):
+    def __init__(self, supernet):
+        import fcntl
+        import json
+        import mmap
+        self.supernet = supernet
+        self.path = os.path.join(ipam_dir, '%s_%s' % (supernet.network, supernet.prefixlen))
+        self.lock = open(self.path + '.lock', 'a')
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        size = max(supernet.size // 8, 1)
+        self.bitmap_file = open(self.path + '.bitmap', 'a+b')
+        if os.path.getsize(self.path + '.bitmap') < size:
+            self.bitmap_file.truncate(size)
+        self.bitmap = mmap.mmap(self.bitmap_file.fileno(), size)
+        try:
+            with open(self.path + '.json') as f:
+                self.index = json.load(f)
+        except IOError:
+            self.index = dict()
+        self.changed = False
+
+    def is_free(self, offset, count):
+        if offset % 8 == 0 and count % 8 == 0:
+            return self.bitmap[offset // 8:(offset + count) // 8] == '\x00' * (count // 8)
+        for n in range(offset, offset + count):
+            if ord(self.bitmap[n // 8]) & (1 << n % 8):
+                return False
+        return True
+
+    def mark(self, offset, count, used):
+        if offset % 8 == 0 and count % 8 == 0:
+            self.bitmap[offset // 8:(offset + count) // 8] = ('\xff' if used else '\x00') * (count // 8)
+            return
+        for n in range(offset, offset + count):
+            byte = ord(self.bitmap[n // 8])
+            byte = byte | (1 << n % 8) if used else byte & ~(1 << n % 8)
+            self.bitmap[n // 8] = chr(byte)
+
+    # Records subnet under key unless key is already assigned
+    def reserve(self, key, subnet):
+        if key not in self.index:
+            self.mark(subnet.first - self.supernet.first, subnet.size, True)
+            self.index[key] = str(subnet)
+            self.changed = True
+
+    # Returns the subnet assigned to key if it is still a /prefixlen, otherwise
+    # assigns the first subnet returned by allocate() that is free in the ledger
+    def assign(self, key, prefixlen, allocate):
+        subnet = IPv4Network(self.index[key]) if key in self.index else None
+        if subnet and subnet.prefixlen == prefixlen:
+            return subnet
+        if subnet:
+            self.mark(subnet.first - self.supernet.first, subnet.size, False)
+        while True:
+            subnet = allocate()
+            offset = subnet.first - self.supernet.first
+            if self.is_free(offset, subnet.size):
+                break
+        self.mark(offset, subnet.size, True)
+        self.index[key] = str(subnet)
+        self.changed = True
+        return subnet
+
+    # The bitmap is flushed before the index is written, so a build that dies
+    # in between can only leave addresses unused, never assigned twice
+    def close(self):
+        import fcntl
+        import json
+        if self.changed:
+            self.bitmap.flush()
+            with open(self.path + '.json.tmp', 'w') as f:
+                json.dump(self.index, f, indent=1, sort_keys=True)
+            os.rename(self.path + '.json.tmp', self.path + '.json')
+        self.bitmap.close()
+        self.bitmap_file.close()
+        fcntl.flock(self.lock, fcntl.LOCK_UN)
+        self.lock.close()
+
+ledger = None
+
+# Allocates the next subnet of cidr for key, from the ledger when there is one
+def assign_subnet(key, allocator, cidr):
+    if ledger is None:
+        return get_subnet(allocator, cidr)
+    return ledger.assign(key, cidr, lambda: get_subnet(allocator, cidr))
+
+
+mark_phase('allocation')
 
 # Define vlans
 # per floor vlans will start with the specified number and add 1 to the end for the floor
@@ -58,133 +400,294 @@ networks = dict()
 networks['base'] = dict()
 networks['base']['vlans'] = base_vlans
 networks['base']['supernet'] = base_net
-networks['base']['subnets'] = sorted(list(base_net.subnet(22)))
+networks['base']['allocator'] = new_allocator(base_net, 22)
 
 # Generate all details for each vlan in built_vlans
-built_vlans = dict()
-floor_vlans = dict()
-global_vlans = list()
-
-for net_type in networks.keys():
-    subnets = networks[net_type]['subnets']
-    for vlan in networks[net_type]['vlans']:
-        if vlan['type'] == 'per_floor':  
-            for floor in range(1, floors+1):
-                if floor not in floor_vlans.keys():
-                    floor_vlans[floor] = list()
+def allocate_vlans(networks):
+    built_vlans = dict()
+    floor_vlans = dict()
+    global_vlans = list()
+
+    for net_type in networks.keys():
+        allocator = networks[net_type]['allocator']
+        for vlan in networks[net_type]['vlans']:
+            if vlan['type'] == 'per_floor':  
+                for floor in range(1, floors+1):
+                    if floor not in floor_vlans.keys():
+                        floor_vlans[floor] = list()
                     
-                number = vlan['number'] + floor
-                desc = '%s_%sFLOOR' % (vlan['name'], floor)
-                subnets, subnet = get_subnet(subnets, vlan['cidr'])
+                    number = vlan['number'] + floor
+                    desc = '%s_%sFLOOR' % (vlan['name'], floor)
+                    subnet = assign_subnet('vlan%s' % number, allocator, vlan['cidr'])
+                    built_vlans[number] = dict()
+                    built_vlans[number]['desc'] = desc
+                    built_vlans[number]['subnet'] = subnet
+                    built_vlans[number]['dhcp'] = vlan['dhcp']
+                    floor_vlans[floor].append(number)
+                
+            elif vlan['type'] == 'global':
+                number = vlan['number']
+                desc = '%s' % vlan['name']
+                subnet = assign_subnet('vlan%s' % number, allocator, vlan['cidr'])
                 built_vlans[number] = dict()
                 built_vlans[number]['desc'] = desc
                 built_vlans[number]['subnet'] = subnet
                 built_vlans[number]['dhcp'] = vlan['dhcp']
-                floor_vlans[floor].append(number)
-                
-        elif vlan['type'] == 'global':
-            number = vlan['number']
-            desc = '%s' % vlan['name']
-            subnets, subnet = get_subnet(subnets, vlan['cidr'])
-            built_vlans[number] = dict()
-            built_vlans[number]['desc'] = desc
-            built_vlans[number]['subnet'] = subnet
-            built_vlans[number]['dhcp'] = vlan['dhcp']
-            global_vlans.append(number)
+                global_vlans.append(number)
+    return built_vlans, floor_vlans, global_vlans
+
+# Determine if Device is 1 or 2
+device_one = True if int(hostname[-1]) % 2 == 0 else False
+
+if ipam_dir:
+    # The MLAG and loopback addresses at the end of base_net are never allocated
+    ledger = Ledger(base_net)
+    ledger.reserve('mlag-loopbacks', get_nth_subnet(base_net, 29, -1))
+try:
+    built_vlans, floor_vlans, global_vlans = allocate_vlans(networks)
+finally:
+    if ledger:
+        ledger.close()
 
 
 # Set MLAG base network
-mlag_net = sorted(list(networks['base']['supernet'].subnet(31)))[-1]
+mlag_net = get_nth_subnet(networks['base']['supernet'], 31, -1)
 
 # Define WAN Peer
 wan_peer = wan_p2p[0] if wan_p2p.prefixlen == 31 else wan_p2p[1]
 
-# Determine if Device is 1 or 2
-device_one = True if int(hostname[-1]) % 2 == 0 else False
-
 # Set Loopback base network
 if device_one:
-    loop_net = sorted(list(networks['base']['supernet'].subnet(32)))[-5]
+    loop_net = get_nth_subnet(networks['base']['supernet'], 32, -5)
 else:
-    loop_net = sorted(list(networks['base']['supernet'].subnet(32)))[-4]
+    loop_net = get_nth_subnet(networks['base']['supernet'], 32, -4)
+
+# Configuration templates
+# Each configlet is rendered into one buffer and written out once
+variables_template = """!! Variables from Builder
+! hostname: %s
+! base_net: %s
+! floors: %s
+! wan_p2p: %s
+! wan_as: %s
+! local_as: %s
+
+"""
+
+routing_template = """hostname %s
+
+ip routing
+
+router multicast
+   ip multicast-routing
+
+router pim sparse-mode
+   ip pim ssm range standard
+   ip pim rp-address %s
+
+"""
+
+null_route_template = """ip route %s/%s Null0
+"""
+
+default_route_template = """ip route 0.0.0.0/0 %s 250
+
+"""
+
+spanning_tree_template = """spanning-tree mode rapid-pvst
+no spanning-tree vlan 4094
+spanning-tree vlan 1-4093 priority 4096
+
+"""
+
+vlan_template = """vlan %s
+   name %s
+
+"""
+
+mlag_vlan_template = """vlan 4094
+   name MLAG_PEERLINK
+   trunk group mlag-peerlink
+
+"""
+
+svi_template = """interface Vlan%s
+   description %s
+   no autostate
+   ip address %s/%s
+"""
+
+svi_helper_template = """   ip helper-address %s
+"""
+
+svi_pim_template = """   ip pim sparse-mode
+   ip virtual-router address %s
+
+"""
+
+mlag_svi_template = """interface Vlan4094
+   description MLAG_SVI
+   no autostate
+   ip address %s/%s
+
+ip virtual-router mac-address 00:1C:73:00:00:01
+
+interface Loopback0
+   ip address %s
+
+"""
+
+downlink_template = """interface Ethernet%s
+   channel-group 10%s mode active
+
+"""
+
+wan_template = """interface %s
+   ip address %s/%s
+   ip pim sparse-mode
+
+"""
+
+peerlink_template = """interface %s
+   channel-group 100 mode active
+
+"""
+
+downlink_po_template = """interface Port-Channel10%s
+   switchport trunk allowed vlan %s
+   switchport mode trunk
+   mlag 10%s
+
+"""
+
+## For fixed devices use reload-delay mlag 360 and non-mlag 300
+## For Chassis use reload-delay mlag 1500 and non-mlag 1200
+mlag_template = """interface Port-Channel100
+   description MLAG-PEERLINK
+   switchport mode trunk
+   switchport trunk group mlag-peerlink
+
+mlag configuration
+   domain-id ARISTA4THEWIN
+   local-interface Vlan4094
+   peer-address %s
+   peer-link Port-Channel100
+   reload-delay mlag 360
+   reload-delay non-mlag 300
+
+"""
+
+bgp_template = """router bgp %s
+   router-id %s
+   distance bgp 20 200 200
+   maximum-paths 64 ecmp 64
+   neighbor %s remote-as %s
+   neighbor %s next-hop-self
+   neighbor %s send-community
+   neighbor %s remote-as %s
+   neighbor %s fall-over bfd
+   neighbor %s send-community
+   network %s
+"""
+
+bgp_network_template = """   network %s/%s
+"""
+
+banner_template = """
+banner motd
+
+ **********************************************************************
+                        LEGAL NOTIFICATION
+ **********************************************************************
+            UNAUTHORIZED USE OF THIS SYSTEM IS PROHIBITED
+ **********************************************************************
+
+                          GET OFF MY LAWN 
+
+ **********************************************************************
+ EOF
+
+"""
+
+management_template = """daemon TerminAttr
+   exec /usr/bin/TerminAttr %s
+   no shutdown
+
+management api http-commands
+   no shutdown
+   protocol https port 443
+   protocol unix-socket
+
+management ssh
+   idle-timeout 5
+
+management console
+   idle-timeout 5
+
+"""
 
 ## Print out Variables used in Form
-print '!! Variables from Builder'
-print '! hostname: %s' % hostname
-print '! base_net: %s' % base_net
-print '! floors: %s' % floors
-print '! wan_p2p: %s' % wan_p2p
-print '! wan_as: %s' % wan_as
-print '! local_as: %s' % local_as
-print ''
+mark_phase('render')
+load_section_cache(hostname)
+config = list()
+config.append(variables_template % (hostname, base_net, floors, wan_p2p, wan_as, local_as))
 
 # Build Unicast and Mcast Routing Configuration
-print 'hostname %s' % hostname
-print ''
-print 'ip routing'
-print ''
-print 'router multicast'
-print '   ip multicast-routing'
-print ''
-print 'router pim sparse-mode'
-print '   ip pim ssm range standard'
-print '   ip pim rp-address %s' % rp
-print ''
-
-# Configure static routes
-for net_type in networks.keys():
-    supernet = networks[net_type]['supernet']
-    print 'ip route %s/%s Null0' % (supernet.network, supernet.prefixlen)
-print 'ip route 0.0.0.0/0 %s 250' % wan_peer
-print ''
+def render_routing():
+    section = list()
+    section.append(routing_template % (hostname, rp))
+
+    # Configure static routes
+    for net_type in networks.keys():
+        supernet = networks[net_type]['supernet']
+        section.append(null_route_template % (supernet.network, supernet.prefixlen))
+    section.append(default_route_template % wan_peer)
+    return ''.join(section)
+
+supernets = [networks[net_type]['supernet'] for net_type in networks.keys()]
+config.append(render_section('routing', [routing_template, null_route_template, default_route_template,
+                                         hostname, rp, supernets, wan_peer], render_routing))
 
 # Build VLAN and Spanning-Tree Configuration
-print 'spanning-tree mode rapid-pvst'
-print 'no spanning-tree vlan 4094'
-print 'spanning-tree vlan 1-4093 priority 4096'
-print ''
-for vlan in sorted(built_vlans.keys()):
-    print 'vlan %s' % vlan
-    print '   name %s' % built_vlans[vlan]['desc']
-    print ''
-
-# Configure MLAG VLAN and iBGP VLAN
-print 'vlan 4094'
-print '   name MLAG_PEERLINK'
-print '   trunk group mlag-peerlink'
-print ''
+def render_vlans():
+    section = list()
+    section.append(spanning_tree_template)
+    for vlan in sorted(built_vlans.keys()):
+        section.append(vlan_template % (vlan, built_vlans[vlan]['desc']))
+
+    # Configure MLAG VLAN and iBGP VLAN
+    section.append(mlag_vlan_template)
+    return ''.join(section)
+
+vlan_descs = [(vlan, built_vlans[vlan]['desc']) for vlan in sorted(built_vlans.keys())]
+config.append(render_section('vlans', [spanning_tree_template, vlan_template, mlag_vlan_template,
+                                       vlan_descs], render_vlans))
 
 # Build Switched Virtual Interface Configuration and Loopbacks
 # Configure virtual-router mac-address
 mlag_ip = mlag_net[0] if device_one else mlag_net[1]
 
-for vlan in sorted(built_vlans.keys()):
-    addr = built_vlans[vlan]['subnet'][2] if device_one else built_vlans[vlan]['subnet'][3]
-    gw = built_vlans[vlan]['subnet'][1]
-    cidr = built_vlans[vlan]['subnet'].prefixlen
-    
-    print 'interface Vlan%s' % vlan
-    print '   description %s' % built_vlans[vlan]['desc']
-    print '   no autostate'
-    print '   ip address %s/%s' % (addr, cidr)
-    
-    if built_vlans[vlan]['dhcp']:
-        print '   ip helper-address %s' % dhcp_ip
+def render_svi():
+    section = list()
+    for vlan in sorted(built_vlans.keys()):
+        addr = built_vlans[vlan]['subnet'][2] if device_one else built_vlans[vlan]['subnet'][3]
+        gw = built_vlans[vlan]['subnet'][1]
+        cidr = built_vlans[vlan]['subnet'].prefixlen
+        
+        section.append(svi_template % (vlan, built_vlans[vlan]['desc'], addr, cidr))
         
-    print '   ip pim sparse-mode'
-    print '   ip virtual-router address %s' % gw
-    print ''
-
-print 'interface Vlan4094'
-print '   description MLAG_SVI'
-print '   no autostate'
-print '   ip address %s/%s' % (mlag_ip, mlag_net.prefixlen)
-print ''
-print 'ip virtual-router mac-address 00:1C:73:00:00:01'
-print ''
-print 'interface Loopback0'
-print '   ip address %s' % loop_net
-print ''
+        if built_vlans[vlan]['dhcp']:
+            section.append(svi_helper_template % dhcp_ip)
+            
+        section.append(svi_pim_template % gw)
+
+    section.append(mlag_svi_template % (mlag_ip, mlag_net.prefixlen, loop_net))
+    return ''.join(section)
+
+svi_vlans = [(vlan, built_vlans[vlan]['desc'], built_vlans[vlan]['subnet'], built_vlans[vlan]['dhcp'])
+             for vlan in sorted(built_vlans.keys())]
+config.append(render_section('svi', [svi_template, svi_helper_template, svi_pim_template, mlag_svi_template,
+                                     svi_vlans, device_one, dhcp_ip, mlag_ip, mlag_net, loop_net], render_svi))
 
 # Build Physical Port Configuration
 # Determines how many ports to reserve for downlinks per floor
@@ -193,87 +696,62 @@ switches_per_floor = 2
 interfaces = range(1,47)
 wan_ip = wan_p2p[1] if wan_p2p.prefixlen == 31 else wan_p2p[2]
 
-for floor in range(1, floors+1):
-    for sw in range(1, switches_per_floor+1):
-        int_number = interfaces.pop(0)
-        print 'interface Ethernet%s' % int_number
-        print '   channel-group 10%s mode active' % int_number
-        print ''
-
-print 'interface %s' % wan_intf
-print '   ip address %s/%s' % (wan_ip, wan_p2p.prefixlen)
-print '   ip pim sparse-mode'
-print ''
-for intf in sorted(peerlink_ints):
-    print 'interface %s' % intf
-    print '   channel-group 100 mode active'
-    print ''
+def render_ports():
+    section = list()
+    ports = list(interfaces)
+    for floor in range(1, floors+1):
+        for sw in range(1, switches_per_floor+1):
+            int_number = ports.pop(0)
+            section.append(downlink_template % (int_number, int_number))
+
+    section.append(wan_template % (wan_intf, wan_ip, wan_p2p.prefixlen))
+    if compact_output:
+        for intf_range in compress_interfaces(peerlink_ints):
+            section.append(peerlink_template % intf_range)
+    else:
+        for intf in sorted(peerlink_ints):
+            section.append(peerlink_template % intf)
+    return ''.join(section)
+
+config.append(render_section('ports', [downlink_template, wan_template, peerlink_template, floors,
+                                       switches_per_floor, interfaces, wan_intf, wan_ip, wan_p2p,
+                                       peerlink_ints, compact_output], render_ports))
 
 # Build out MLAG details
 # Build Port-Channels configuration for each floor and peer-link
-interfaces = range(1,47)
 mlag_peer = mlag_net[1] if device_one else mlag_net[0]
 
-for floor in range(1, floors+1):
-    floor_vlans[floor].extend(global_vlans)
-    vlans = sorted(floor_vlans[floor])
-    for sw in range(1, switches_per_floor+1):
-        int_number = interfaces.pop(0)
-        print 'interface Port-Channel10%s' % int_number
-        print '   switchport trunk allowed vlan %s' % (','.join(str(x) for x in vlans))
-        print '   switchport mode trunk'
-        print '   mlag 10%s' % int_number
-        print ''
-
-print 'interface Port-Channel100'
-print '   description MLAG-PEERLINK'
-print '   switchport mode trunk'
-print '   switchport trunk group mlag-peerlink'
-print ''
-print 'mlag configuration'
-print '   domain-id ARISTA4THEWIN'
-print '   local-interface Vlan4094'
-print '   peer-address %s' % mlag_peer
-print '   peer-link Port-Channel100'
-## For fixed devices use value below
-print '   reload-delay mlag 360'
-print '   reload-delay non-mlag 300'
-## For Chassis use value below
-#print '   reload-delay mlag 1500'
-#print '   reload-delay non-mlag 1200'
-print ''
+def render_mlag():
+    section = list()
+    ports = list(interfaces)
+    for floor in range(1, floors+1):
+        vlans = sorted(floor_vlans[floor] + global_vlans)
+        for sw in range(1, switches_per_floor+1):
+            int_number = ports.pop(0)
+            allowed = compress_numbers(vlans) if compact_output else ','.join(str(x) for x in vlans)
+            section.append(downlink_po_template % (int_number, allowed, int_number))
 
-# Build BGP Configuration and advertise networks
-print 'router bgp %s' % local_as
-print '   router-id %s' % loop_net[0]
-print '   distance bgp 20 200 200'
-print '   maximum-paths 64 ecmp 64'
-print '   neighbor %s remote-as %s' % (mlag_peer, local_as)
-print '   neighbor %s next-hop-self' % mlag_peer
-print '   neighbor %s send-community' % mlag_peer
-print '   neighbor %s remote-as %s' % (wan_peer, wan_as)
-print '   neighbor %s fall-over bfd' % wan_peer
-print '   neighbor %s send-community' % wan_peer
-print '   network %s' % loop_net
-for net_type in networks.keys():
-  base = networks[net_type]['supernet']
-  print '   network %s/%s' % (base.network, base.prefixlen)
-print ''
-
-print '''
-banner motd
+    section.append(mlag_template % mlag_peer)
+    return ''.join(section)
 
- **********************************************************************
-                        LEGAL NOTIFICATION
- **********************************************************************
-            UNAUTHORIZED USE OF THIS SYSTEM IS PROHIBITED
- **********************************************************************
+config.append(render_section('mlag', [downlink_po_template, mlag_template, floors, switches_per_floor,
+                                      interfaces, floor_vlans, global_vlans, mlag_peer, compact_output],
+                                     render_mlag))
 
-                          GET OFF MY LAWN 
+# Build BGP Configuration and advertise networks
+def render_bgp():
+    section = list()
+    section.append(bgp_template % (local_as, loop_net[0], mlag_peer, local_as, mlag_peer, mlag_peer,
+                                   wan_peer, wan_as, wan_peer, wan_peer, loop_net))
+    for base in supernets:
+        section.append(bgp_network_template % (base.network, base.prefixlen))
+    section.append('\n')
+    return ''.join(section)
 
- **********************************************************************
- EOF
-'''
+config.append(render_section('bgp', [bgp_template, bgp_network_template, local_as, loop_net, mlag_peer,
+                                     wan_peer, wan_as, supernets], render_bgp))
+
+config.append(banner_template)
 
 # Set Telemetry details
 ### Using the CVP device interface for receiving telemetry data
@@ -291,32 +769,58 @@ smash_exclude_list.append('hardware')
 smash_exclude_list.append('kni')
 smash_exclude_list.append('pulse')
 smash_exclude_list.append('strata')
-smash_exclude = ','.join(smash_exclude_list)
 
 ### Paths to exclude from the ingest stream
 ingest_exclude_list = list()
 ingest_exclude_list.append('/Sysdb/cell/1/agent')
 ingest_exclude_list.append('/Sysdb/cell/2/agent')
-ingest_exclude = ','.join(ingest_exclude_list)
+
+### Telemetry profiles, from the least to the most streamed to CVP
+###  smash_exclude   Smash tables to exclude
+###  ingest_exclude  paths to exclude from the ingest stream
+###  taillogs        stream the device logs
+###  compression     compression of the stream to CVP, None to send it uncompressed
+### telemetry_estimate.py compares them on a state sample recorded from a switch
+# Can be changed to fit environment
+telemetry_profiles = dict()
+telemetry_profiles['minimal'] = {'smash_exclude': smash_exclude_list + ['arp', 'bridging', 'routing', 'routing6'],
+                                 'ingest_exclude': ingest_exclude_list, 'taillogs': False,
+                                 'compression': 'gzip'}
+telemetry_profiles['standard'] = {'smash_exclude': smash_exclude_list, 'ingest_exclude': ingest_exclude_list,
+                                  'taillogs': True, 'compression': 'gzip'}
+telemetry_profiles['full'] = {'smash_exclude': [], 'ingest_exclude': [], 'taillogs': True,
+                              'compression': 'gzip'}
+
+### Profile streamed by this site, from the telemetry_profile Form field
+if telemetry_profile not in telemetry_profiles:
+    raise ValueError('unknown telemetry profile %s, expected one of %s'
+                     % (telemetry_profile, ', '.join(sorted(telemetry_profiles.keys()))))
+profile = telemetry_profiles[telemetry_profile]
 
 ### Getting the Ingest Key
 ### Changing CVP's Ingest key requires a CVP restart
 ingest_key = os.environ.get('AERIS_INGEST_KEY', '')
 
-print 'daemon TerminAttr'
-print '   exec /usr/bin/TerminAttr -ingestgrpcurl=%s -taillogs ' \
-      '-ingestauth=key,%s -smashexcludes=%s -ingestexclude=%s ' \
-      '-ingestvrf=default -cvcompression=gzip' % (ingest_grpc, ingest_key, smash_exclude, ingest_exclude)
-print '   no shutdown'
-print ''
-print 'management api http-commands'
-print '   no shutdown'
-print '   protocol https port 443' 
-print '   protocol unix-socket'
-print ''
-print 'management ssh'
-print '   idle-timeout 5'
-print ''
-print 'management console'
-print '   idle-timeout 5'
-print ''
\ No newline at end of file
+### TerminAttr arguments for the profile
+terminattr_args = ['-ingestgrpcurl=%s' % ingest_grpc]
+if profile['taillogs']:
+    terminattr_args.append('-taillogs')
+terminattr_args.append('-ingestauth=key,%s' % ingest_key)
+if profile['smash_exclude']:
+    terminattr_args.append('-smashexcludes=%s' % ','.join(profile['smash_exclude']))
+if profile['ingest_exclude']:
+    terminattr_args.append('-ingestexclude=%s' % ','.join(profile['ingest_exclude']))
+terminattr_args.append('-ingestvrf=default')
+if profile['compression']:
+    terminattr_args.append('-cvcompression=%s' % profile['compression'])
+terminattr_args = ' '.join(terminattr_args)
+
+telemetry_inputs = [management_template, terminattr_args]
+config.append(render_section('telemetry', telemetry_inputs,
+                             lambda: management_template % terminattr_args))
+save_section_cache(hostname)
+
+mark_phase(None)
+if metrics_enabled:
+    config.append(write_metrics(hostname))
+sys.stdout.write(''.join(config))
@@ -1,30 +1,94 @@
 from cvplibrary import CVPGlobalVariables as cvp_vars
 from cvplibrary import GlobalVariableNames as cvp_names
-from cvplibrary import RestClient
 from cvplibrary import Form
 
-import netaddr
-import jsonrpclib
-import json
+import threading
+import socket
+import sys
+import array
+import os
+import bisect
+import time
+import random
 
 
+# IPv4 addresses are handled as plain ints
+# IPv4Network covers the parts of netaddr.IPNetwork the builders use
+def ip_to_int(text):
+    octets = [int(octet) for octet in text.split('.')]
+    if len(octets) != 4 or [octet for octet in octets if not 0 <= octet <= 255]:
+        raise ValueError('invalid IPv4 address %s' % text)
+    return (octets[0] << 24) | (octets[1] << 16) | (octets[2] << 8) | octets[3]
+
+def int_to_ip(value):
+    return '%s.%s.%s.%s' % (value >> 24, (value >> 16) & 255, (value >> 8) & 255, value & 255)
+
+# str() keeps the address as given, like netaddr, while first, last, network
+# and indexing work on the masked network address
+class IPv4Network(object):
+    __slots__ = ('ip', 'prefixlen')
+
+    def __init__(self, ip, prefixlen=32):
+        if isinstance(ip, basestring):
+            if '/' in ip:
+                ip, prefixlen = ip.split('/')
+            ip = ip_to_int(ip)
+        prefixlen = int(prefixlen)
+        if not 0 <= prefixlen <= 32:
+            raise ValueError('invalid prefix length %s' % prefixlen)
+        self.ip = ip
+        self.prefixlen = prefixlen
+
+    @property
+    def size(self):
+        return 2 ** (32 - self.prefixlen)
+
+    @property
+    def first(self):
+        return self.ip & ~(self.size - 1)
+
+    @property
+    def last(self):
+        return self.first + self.size - 1
+
+    @property
+    def network(self):
+        return int_to_ip(self.first)
+
+    # Address at index from the network address, negative indexes count back
+    # from the broadcast address
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError('no address at index %s in %s' % (index, self))
+        return int_to_ip(self.first + index)
+
+    def __str__(self):
+        return '%s/%s' % (int_to_ip(self.ip), self.prefixlen)
+
+    def __repr__(self):
+        return 'IPv4Network(%r)' % str(self)
+
 # Set Variables based on Form and static
 base_net = Form.getFieldById('supernet').getValue()
-base_net = netaddr.IPNetwork(base_net)
+base_net = IPv4Network(base_net)
 lo0 = Form.getFieldById('lo0').getValue()
-lo0 = netaddr.IPNetwork('%s/32' % lo0)
+lo0 = IPv4Network(lo0, 32)
 asn = Form.getFieldById('asn').getValue().upper()
 leaf_asn = Form.getFieldById('leaf_asn').getValue()
-start = int(leaf_asn.split('-')[0])
-end = int(leaf_asn.split('-')[-1])
-leaf_asn = range(start, end+1)
+# Only the ends of the range are used, 4-byte ASN ranges are never listed out
+leaf_asn = (int(leaf_asn.split('-')[0]), int(leaf_asn.split('-')[-1]))
 mac = cvp_vars.getValue(cvp_names.CVP_MAC)
 
 # Can be changed to fit environment
 p2p_cidr = 31
 
 # Functions
-def get_credentials(ztp=cvp_vars.getValue(cvp_names.ZTP_STATE)):
+# ZTP_STATE is read when credentials are first needed, not when the builder loads
+def get_credentials(ztp=None):
+    if ztp is None:
+        ztp = cvp_vars.getValue(cvp_names.ZTP_STATE)
     if ztp == 'true':
         user = cvp_vars.getValue(cvp_names.ZTP_USERNAME)
         pwd = cvp_vars.getValue(cvp_names.ZTP_PASSWORD)
@@ -33,13 +97,106 @@ def get_credentials(ztp=cvp_vars.getValue(cvp_names.ZTP_STATE)):
         pwd = cvp_vars.getValue(cvp_names.CVP_PASSWORD)
     return (user, pwd)
 
+# Calls to devices and CVP share a latency budget of build_budget seconds
+# Each call times out after call_timeout seconds. Calls that time out or fail
+# to connect are retried up to call_retries times with a jittered backoff
+# while the budget lasts, other errors are raised at once. A device that
+# fails breaker_threshold calls in a row is not called again
+# Shared with the other eAPI builders, check_shared.py keeps the copies identical
+# Can be changed to fit environment
+build_budget = 60
+call_timeout = 10
+call_retries = 2
+retry_backoff = 0.5
+breaker_threshold = 3
+build_deadline = time.time() + build_budget
+breaker = dict()
+breaker_lock = threading.Lock()
+
+class DeviceUnavailable(Exception):
+    pass
+
+# Errors worth a retry, the call timed out or the connection failed. HTTP
+# errors such as a 404 from CVP carry a code and are not retried
+def is_transient(e):
+    if isinstance(e, DeviceUnavailable):
+        return True
+    return isinstance(e, (socket.error, IOError)) and not hasattr(e, 'code')
+
+# Runs func(*args) in a separate thread and gives up after timeout seconds
+def call_with_timeout(func, args, timeout):
+    result = list()
+    def call():
+        try:
+            result.append((True, func(*args)))
+        except Exception:
+            result.append((False, sys.exc_info()))
+    thread = threading.Thread(target=call)
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    if not result:
+        raise DeviceUnavailable('call timed out after %.1fs' % timeout)
+    if not result[0][0]:
+        error = result[0][1]
+        raise error[0], error[1], error[2]
+    return result[0][1]
+
+# Runs func(*args) on device with call_timeout and retries inside the budget
+def call_device(device, func, *args):
+    attempt = 0
+    while True:
+        with breaker_lock:
+            failures = breaker.get(device, 0)
+        if failures >= breaker_threshold:
+            raise DeviceUnavailable('%s failed %s calls in a row' % (device, failures))
+        remaining = build_deadline - time.time()
+        if remaining <= 0:
+            raise DeviceUnavailable('build budget of %ss used up before calling %s' % (build_budget, device))
+        try:
+            result = call_with_timeout(func, args, min(call_timeout, remaining))
+        except Exception, e:
+            if not is_transient(e):
+                raise
+            with breaker_lock:
+                breaker[device] = breaker.get(device, 0) + 1
+            attempt += 1
+            if attempt > call_retries:
+                raise DeviceUnavailable('%s: %s' % (device, e))
+            delay = retry_backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+            time.sleep(max(0, min(delay, build_deadline - time.time())))
+            continue
+        with breaker_lock:
+            breaker[device] = 0
+        return result
+
+# eAPI connections are pooled per device and kept open between calls
+# jsonrpclib is only imported when the first connection is opened
+# eapi_pool_size limits the idle connections kept for each device
+# Can be changed to fit environment
+eapi_pool_size = 4
+eapi_pool = dict()
+eapi_pool_lock = threading.Lock()
+
 def send_command(user, pwd, ip, commands, https=False):
-    if https:
-        url = 'https://%s:%s@%s/command-api' % (user, pwd, ip)
-    else:
-        url = 'http://%s:%s@%s/command-api' % (user, pwd, ip)
-    sw = jsonrpclib.Server(url)
+    return call_device(ip, run_commands, user, pwd, ip, commands, https)
+
+def run_commands(user, pwd, ip, commands, https=False):
+    key = (user, pwd, ip, https)
+    with eapi_pool_lock:
+        idle = eapi_pool.setdefault(key, list())
+        sw = idle.pop() if idle else None
+    if sw is None:
+        if https:
+            url = 'https://%s:%s@%s/command-api' % (user, pwd, ip)
+        else:
+            url = 'http://%s:%s@%s/command-api' % (user, pwd, ip)
+        import jsonrpclib
+        sw = jsonrpclib.Server(url)
     result = sw.runCmds(1, commands)
+    with eapi_pool_lock:
+        if len(eapi_pool[key]) < eapi_pool_size:
+            eapi_pool[key].append(sw)
     return result
 
 def get_interfaces():
@@ -66,35 +223,324 @@ def get_interfaces():
             
     return sorted(interfaces)
 
+# Returns the subnet at index in supernet.subnet(prefixlen) without listing them
+# Negative indexes count back from the end of supernet
+def get_nth_subnet(supernet, prefixlen, index):
+    count = 2 ** (prefixlen - supernet.prefixlen) if prefixlen >= supernet.prefixlen else 0
+    if index < 0:
+        index += count
+    if not 0 <= index < count:
+        raise IndexError('no /%s at index %s in %s' % (prefixlen, index, supernet))
+    start = supernet.first + index * 2 ** (32 - prefixlen)
+    return IPv4Network(start, prefixlen)
+
+# Allocations can be kept in an on-disk ledger in ipam_dir so that they stay
+# the same from build to build, whatever else changes in the Form. Each
+# supernet gets a memory-mapped bitmap with one bit per address and an index
+# of its assignments by key, both guarded by a file lock so that builders
+# running at the same time can share them. Needs mmap and fcntl, so it is
+# only available to offline builds, not in CVP. None disables the ledger
+# Shared with the other builders, check_shared.py keeps the copies identical
+# Can be changed to fit environment
+ipam_dir = None
+
+class Ledger(object):
+    def __init__(self, supernet):
+        import fcntl
+        import json
+        import mmap
+        self.supernet = supernet
+        self.path = os.path.join(ipam_dir, '%s_%s' % (supernet.network, supernet.prefixlen))
+        self.lock = open(self.path + '.lock', 'a')
+        fcntl.flock(self.lock, fcntl.LOCK_EX)
+        size = max(supernet.size // 8, 1)
+        self.bitmap_file = open(self.path + '.bitmap', 'a+b')
+        if os.path.getsize(self.path + '.bitmap') < size:
+            self.bitmap_file.truncate(size)
+        self.bitmap = mmap.mmap(self.bitmap_file.fileno(), size)
+        try:
+            with open(self.path + '.json') as f:
+                self.index = json.load(f)
+        except IOError:
+            self.index = dict()
+        self.changed = False
+
+    def is_free(self, offset, count):
+        if offset % 8 == 0 and count % 8 == 0:
+            return self.bitmap[offset // 8:(offset + count) // 8] == '\x00' * (count // 8)
+        for n in range(offset, offset + count):
+            if ord(self.bitmap[n // 8]) & (1 << n % 8):
+                return False
+        return True
+
+    def mark(self, offset, count, used):
+        if offset % 8 == 0 and count % 8 == 0:
+            self.bitmap[offset // 8:(offset + count) // 8] = ('\xff' if used else '\x00') * (count // 8)
+            return
+        for n in range(offset, offset + count):
+            byte = ord(self.bitmap[n // 8])
+            byte = byte | (1 << n % 8) if used else byte & ~(1 << n % 8)
+            self.bitmap[n // 8] = chr(byte)
+
+    # Records subnet under key unless key is already assigned
+    def reserve(self, key, subnet):
+        if key not in self.index:
+            self.mark(subnet.first - self.supernet.first, subnet.size, True)
+            self.index[key] = str(subnet)
+            self.changed = True
+
+    # Returns the subnet assigned to key if it is still a /prefixlen, otherwise
+    # assigns the first subnet returned by allocate() that is free in the ledger
+    def assign(self, key, prefixlen, allocate):
+        subnet = IPv4Network(self.index[key]) if key in self.index else None
+        if subnet and subnet.prefixlen == prefixlen:
+            return subnet
+        if subnet:
+            self.mark(subnet.first - self.supernet.first, subnet.size, False)
+        while True:
+            subnet = allocate()
+            offset = subnet.first - self.supernet.first
+            if self.is_free(offset, subnet.size):
+                break
+        self.mark(offset, subnet.size, True)
+        self.index[key] = str(subnet)
+        self.changed = True
+        return subnet
+
+    # The bitmap is flushed before the index is written, so a build that dies
+    # in between can only leave addresses unused, never assigned twice
+    def close(self):
+        import fcntl
+        import json
+        if self.changed:
+            self.bitmap.flush()
+            with open(self.path + '.json.tmp', 'w') as f:
+                json.dump(self.index, f, indent=1, sort_keys=True)
+            os.rename(self.path + '.json.tmp', self.path + '.json')
+        self.bitmap.close()
+        self.bitmap_file.close()
+        fcntl.flock(self.lock, fcntl.LOCK_UN)
+        self.lock.close()
+
+# Builds the p2p addressing plan for this spine
+# p2p_cidr subnets of supernet are assigned to the sorted interfaces in order
+# Returns interface -> index and an array of spine addresses at those indexes
+# The leaf builders compute the same plan, so changes must be made in all of them
+# With a ledger each interface keeps the subnet it was first given, new
+# interfaces take the lowest free ones and leaves must discover their addresses
+def get_p2p_table(supernet, interfaces):
+    ports = dict()
+    table = array.array('I')
+    ledger = Ledger(supernet) if ipam_dir else None
+    cursor = [0]
+    def next_subnet():
+        cursor[0] += 1
+        return get_nth_subnet(supernet, p2p_cidr, cursor[0] - 1)
+    try:
+        for index, _int in enumerate(sorted(interfaces)):
+            if ledger:
+                subnet = ledger.assign('p2p:%s' % _int, p2p_cidr, next_subnet)
+            else:
+                subnet = get_nth_subnet(supernet, p2p_cidr, index)
+            ports[_int] = index
+            table.append(subnet.first if subnet.prefixlen == 31 else subnet.first + 1)
+    finally:
+        if ledger:
+            ledger.close()
+    return ports, table
+
+
+# Output is compacted when compact_output is set, VLAN lists are written as
+# ranges and settings shared by many interfaces are applied to interface ranges
+# Can be changed to fit environment
+compact_output = False
+
+# Collapses numbers into ranges, e.g. 101,102,103,470 -> 101-103,470
+def compress_numbers(numbers):
+    ranges = list()
+    for number in sorted(set(numbers)):
+        if ranges and ranges[-1][1] == number - 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ','.join('%s-%s' % (a, b) if a != b else str(a) for a, b in ranges)
+
+# Collapses interface names into one range per run of consecutive ports,
+# e.g. Ethernet1,Ethernet2,Ethernet3,Ethernet5 -> Ethernet1-3 and Ethernet5
+# Returns a list of ranges, each usable as "interface <range>"
+def compress_interfaces(names):
+    ports = set()
+    for name in names:
+        stem = name.rstrip('0123456789')
+        ports.add((stem, int(name[len(stem):]) if stem != name else None))
+    runs = list()
+    for stem, number in sorted(ports):
+        if number is not None and runs and runs[-1][0] == stem and runs[-1][2] == number - 1:
+            runs[-1][2] = number
+        else:
+            runs.append([stem, number, number])
+    ranges = list()
+    for stem, first, last in runs:
+        if first is None:
+            ranges.append(stem)
+        elif first == last:
+            ranges.append('%s%s' % (stem, first))
+        else:
+            ranges.append('%s%s-%s' % (stem, first, last))
+    return ranges
+
+# Build metrics, off by default
+# metrics_comment appends phase times, call latencies and peak memory to the
+# configlet as ! comments, metrics_file appends them to that file as JSON lines
+# Shared with the other builders, check_shared.py keeps the copies identical
+# Can be changed to fit environment
+metrics_comment = False
+metrics_file = None
+metrics_enabled = metrics_comment or bool(metrics_file)
+metrics_buckets = [0.005, 0.01, 0.05, 0.1, 0.5, 1, 5]
+metrics = {'phases': list(), 'phase': None, 'calls': dict()}
+metrics_lock = threading.Lock()
+
+# Ends the running phase and starts the next, None ends the last phase
+def mark_phase(name):
+    if not metrics_enabled:
+        return
+    now = time.time()
+    if metrics['phase']:
+        metrics['phases'].append((metrics['phase'][0], now - metrics['phase'][1]))
+    metrics['phase'] = (name, now) if name else None
+
+# Returns func with its calls timed under kind when metrics are enabled
+def instrument(kind, func):
+    if not metrics_enabled:
+        return func
+    def timed(*args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record_call(kind, time.time() - start)
+    return timed
+
+def record_call(kind, elapsed):
+    with metrics_lock:
+        if kind not in metrics['calls']:
+            metrics['calls'][kind] = {'count': 0, 'total': 0.0, 'max': 0.0,
+                                      'histogram': [0] * (len(metrics_buckets) + 1)}
+        calls = metrics['calls'][kind]
+        calls['count'] += 1
+        calls['total'] += elapsed
+        calls['max'] = max(calls['max'], elapsed)
+        calls['histogram'][bisect.bisect_left(metrics_buckets, elapsed)] += 1
+
+def get_metrics_report(device):
+    report = dict()
+    report['builder'] = os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else None
+    report['device'] = device
+    report['time'] = time.time()
+    report['phases'] = metrics['phases']
+    report['calls'] = metrics['calls']
+    report['buckets'] = metrics_buckets
+    try:
+        import resource
+        report['peak_memory_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        report['peak_memory_kb'] = None
+    return report
+
+def format_metrics(report):
+    lines = ['!! Builder metrics']
+    for name, elapsed in report['phases']:
+        lines.append('! phase %s: %.3fs' % (name, elapsed))
+    for kind in sorted(report['calls'].keys()):
+        calls = report['calls'][kind]
+        buckets = ['<=%sms:%s' % (int(limit * 1000), count)
+                   for limit, count in zip(report['buckets'], calls['histogram'])]
+        buckets.append('>%sms:%s' % (int(report['buckets'][-1] * 1000), calls['histogram'][-1]))
+        lines.append('! %s calls: %s, total %.3fs, max %.3fs' % (kind, calls['count'], calls['total'], calls['max']))
+        lines.append('!   %s' % ' '.join(buckets))
+    lines.append('! peak memory: %s KB' % report['peak_memory_kb'])
+    return '\n'.join(lines) + '\n'
+
+def write_metrics(device):
+    report = get_metrics_report(device)
+    if metrics_file:
+        import json
+        with metrics_lock:
+            with open(metrics_file, 'a') as f:
+                f.write(json.dumps(report) + '\n')
+    return format_metrics(report) if metrics_comment else ''
+
+send_command = instrument('eapi', send_command)
+
+
+# Configuration templates
+# Each configlet is rendered into one buffer and written out once
+routing_template = """ip routing
+
+"""
+
+interface_template = """interface %s
+   no switchport
+   ip address %s/%s
+
+"""
+
+routed_range_template = """interface %s
+   no switchport
+
+"""
+
+interface_address_template = """interface %s
+   ip address %s/%s
+
+"""
+
+loopback_template = """interface Loopback0
+   ip address %s
+
+peer-filter leaves-asn
+   match as-range %s-%s result accept
+
+"""
+
+bgp_template = """router bgp %s
+   router-id %s
+   distance bgp 20 200 200
+   maximum-paths 64 ecmp 64
+   neighbor leaves peer-group
+   neighbor leaves send-community
+   bgp listen range %s peer-group leaves peer-filter leaves-asn
+   network %s
+
+"""
+
 
 # Start of Configuration Output
-print 'ip routing'
-print ''
+mark_phase('interfaces')
+config = list()
+config.append(routing_template)
 
 interfaces = get_interfaces()
-subnets = sorted(base_net.subnet(p2p_cidr))
+mark_phase('addressing')
+ports, p2p_table = get_p2p_table(base_net, interfaces)
+mark_phase('render')
+
+if compact_output:
+    for intf_range in compress_interfaces(interfaces):
+        config.append(routed_range_template % intf_range)
 
 for _int in interfaces:
-    subnet = subnets.pop(0)
-    ip = subnet[0] if subnet.prefixlen == 31 else subnet[1]
-    print 'interface %s' % _int
-    print '   no switchport'
-    print '   ip address %s/%s' % (ip, subnet.prefixlen)
-    print ''
-  
-print 'interface Loopback0'
-print '   ip address %s' % lo0
-print ''
-print 'peer-filter leaves-asn'
-print '   match as-range %s-%s result accept' % (leaf_asn[0], leaf_asn[-1])
-print ''
-
-print 'router bgp %s' % asn
-print '   router-id %s' % lo0[0]
-print '   distance bgp 20 200 200'
-print '   maximum-paths 64 ecmp 64'
-print '   neighbor leaves peer-group'
-print '   neighbor leaves send-community'
-print '   bgp listen range %s peer-group leaves peer-filter leaves-asn' % base_net
-print '   network %s' % lo0
-print ''
+    ip = int_to_ip(p2p_table[ports[_int]])
+    if compact_output:
+        config.append(interface_address_template % (_int, ip, p2p_cidr))
+    else:
+        config.append(interface_template % (_int, ip, p2p_cidr))
+
+config.append(loopback_template % (lo0, leaf_asn[0], leaf_asn[-1]))
+config.append(bgp_template % (asn, lo0[0], base_net, lo0))
+
+mark_phase(None)
+if metrics_enabled:
+    config.append(write_metrics(mac))
+sys.stdout.write(''.join(config))
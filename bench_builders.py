@@ -0,0 +1,123 @@
+# End-to-end benchmark for the configlet builders.
+# Runs every builder against fake_fabric.py for a range of topology sizes and
+# reports the wall time and eAPI/CVP round trips per device for each builder.
+#
+# Usage: python bench_builders.py [--sizes 4,16,64] [--latency 0.02] [--jitter 0.01]
+
+import optparse
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+import fake_fabric
+import fleet_build
+
+
+builders = [
+    ('SpineBuilder', 'SAMPLE-SpineBuilder.py', 'spine'),
+    ('LeafBuilder', 'SAMPLE-LeafBuilder.py', 'leaf'),
+    ('LeafBuilderv2', 'SAMPLE-LeafBuilderv2.py', 'leafv2'),
+    ('RemoteBuilding', 'SAMPLE-RemoteBuilding.py', 'remote'),
+]
+
+
+# RemoteBuilding needs no fabric, one site pair per two leaves of the topology
+def remote_rows(count):
+    rows = list()
+    for number in range(1, count + 1):
+        hostname = 'BLDG%s-%s' % ((number + 1) // 2, 2 - number % 2)
+        rows.append({'device': hostname, 'hostname': hostname, 'floors': '4',
+                     'base_net': '10.%s.0.0/16' % (64 + number % 128),
+                     'wan_p2p': '172.16.%s.%s/31' % (number // 128, number * 2 % 256),
+                     'wan_intf': 'Ethernet48', 'peerlink': 'Ethernet49,Ethernet50',
+                     'wan_as': '65000', 'local_as': '65100', 'rp': '10.255.255.1',
+                     'dhcp': '10.9.9.9', 'env.PRIMARY_DEVICE_INTF_IP': '10.0.0.1'})
+    return rows
+
+
+# Self-signed certificate so the fake fabric can serve the https builders
+def make_certificate(directory):
+    certfile = os.path.join(directory, 'fabric.pem')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                               '-days', '1', '-subj', '/CN=fake-fabric',
+                               '-keyout', certfile, '-out', certfile],
+                              stdout=devnull, stderr=devnull)
+    return certfile
+
+
+resolver = (socket.gethostbyaddr, socket.gethostbyname)
+
+
+def run_size(size, options, workdir, certfile):
+    topology = fake_fabric.build_topology(options.spines, size, options.port)
+    topology['rows']['remote'] = remote_rows(size)
+    server = fake_fabric.FabricServer(topology, ('', options.port), options.latency,
+                                      options.jitter, certfile)
+    server.start()
+    fleet_build.install_cvplibrary('http://127.0.0.1:%s' % options.port, 'cvpadmin', 'arista')
+
+    # Stand-in resolver for the DNS lookups in LeafBuilderv2
+    dns = topology['dns']
+    socket.gethostbyaddr = lambda ip: (dns[ip], [], [ip]) if ip in dns else resolver[0](ip)
+    socket.gethostbyname = lambda name: dns[name] if name in dns else resolver[1](name)
+
+    results = list()
+    try:
+        for name, script, key in builders:
+            rows = topology['rows'][key]
+            server.reset()
+            errors = 0
+            start = time.time()
+            for row in rows:
+                row = dict(row, builder=os.path.join(options.builders, script))
+                device, error = fleet_build.build_device((row, workdir))
+                if error:
+                    errors += 1
+                    sys.stderr.write('%s %s: %s\n' % (name, device, error))
+            elapsed = time.time() - start
+            calls = server.calls['eapi'] + server.calls['cvp']
+            results.append((size, name, len(rows), elapsed, calls, errors))
+    finally:
+        server.stop()
+    return results
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--sizes', default='4,16,64', help='leaves per topology [%default]')
+    parser.add_option('--spines', type='int', default=2)
+    parser.add_option('--latency', type='float', default=0.02, help='seconds per call [%default]')
+    parser.add_option('--jitter', type='float', default=0.01, help='extra seconds per call [%default]')
+    parser.add_option('--port', type='int', default=18080)
+    parser.add_option('--builders', default=os.path.dirname(os.path.abspath(__file__)),
+                      help='directory holding the builder scripts')
+    options, args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='bench_builders')
+    try:
+        try:
+            certfile = make_certificate(workdir)
+            ssl._create_default_https_context = ssl._create_unverified_context
+        except (OSError, subprocess.CalledProcessError):
+            sys.stderr.write('openssl not available, https builders will fail\n')
+            certfile = None
+
+        print '%6s  %-15s %7s %10s %12s %12s %6s' % ('size', 'builder', 'devices', 'wall s',
+                                                    'ms/device', 'calls/device', 'errors')
+        for size in [int(s) for s in options.sizes.split(',')]:
+            for size, name, devices, elapsed, calls, errors in run_size(size, options, workdir, certfile):
+                print '%6s  %-15s %7s %10.2f %12.1f %12.2f %6s' % (
+                    size, name, devices, elapsed, elapsed * 1000 / devices,
+                    float(calls) / devices, errors)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main()
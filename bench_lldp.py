@@ -0,0 +1,85 @@
+# LLDP retrieval benchmark for the leaf builders.
+# Builds the eAPI responses a leaf with many LLDP neighbors returns for each
+# lldp_mode and reports the response size and the median time to get the
+# neighbors on routed_ints out of it. extract_entries is taken from the
+# builder source, so the code measured is the code the builder runs.
+#
+# Usage: python bench_lldp.py [--neighbors 500] [--runs 50] [SAMPLE-LeafBuilder.py]
+
+import ast
+import json
+import optparse
+import os
+import re
+import time
+
+import fake_fabric
+
+
+routed_ints = ['Ethernet2', 'Ethernet3']
+
+
+def load_function(path, name):
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and node.name == name:
+            scope = {'json': json, 're': re}
+            exec compile(ast.Module([node]), path, 'exec') in scope
+            return scope[name]
+    raise SystemExit('%s has no %s' % (path, name))
+
+
+def response(results):
+    return json.dumps({'jsonrpc': '2.0', 'id': 1, 'result': results})
+
+
+def median_time(func, runs):
+    times = list()
+    for _ in range(runs):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [leaf builder]')
+    parser.add_option('--neighbors', type='int', default=500, help='LLDP neighbors on the leaf [%default]')
+    parser.add_option('--runs', type='int', default=50, help='parses per mode [%default]')
+    options, args = parser.parse_args()
+    here = os.path.dirname(os.path.abspath(__file__))
+    builder = args[0] if args else os.path.join(here, 'SAMPLE-LeafBuilder.py')
+    extract_entries = load_function(builder, 'extract_entries')
+
+    topology = fake_fabric.build_topology(2, 2, neighbors=options.neighbors)
+    commands = topology['devices'][fake_fabric.device_ip(2, 1)]['commands']
+    full = response([commands['show lldp neighbors detail']])
+    scoped = response([commands['show lldp neighbors %s detail' % _int] for _int in routed_ints])
+
+    def parse_full():
+        lldp_info = json.loads(full)['result'][0]['lldpNeighbors']
+        return dict((_int, lldp_info[_int]) for _int in routed_ints)
+
+    def parse_scoped():
+        lldp_info = dict()
+        for result in json.loads(scoped)['result']:
+            lldp_info.update(result['lldpNeighbors'])
+        return lldp_info
+
+    def parse_stream():
+        return extract_entries(full, 'lldpNeighbors', routed_ints)
+
+    modes = [('full', full, parse_full), ('scoped', scoped, parse_scoped), ('stream', full, parse_stream)]
+    expected = parse_full()
+    total = len(json.loads(full)['result'][0]['lldpNeighbors'])
+    print '%s, %s LLDP neighbors' % (os.path.basename(builder), total)
+    print '%-8s %12s %10s' % ('mode', 'bytes', 'parse ms')
+    for mode, text, parse in modes:
+        if parse() != expected:
+            raise SystemExit('%s mode returned different neighbors' % mode)
+        print '%-8s %12s %10.3f' % (mode, len(text), median_time(parse, options.runs) * 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+# Scaling benchmark for the addressing and rendering in the configlet builders.
+# Runs SpineBuilder and RemoteBuilding over a sweep of supernet sizes,
+# interface counts and floor counts, with no network: Form values come from
+# the fleet_build.py stand-in cvplibrary and eAPI from a stub jsonrpclib.
+#
+# Each build runs in a fresh interpreter with the builder's module level
+# code split into stages at its mark_phase() calls, so every stage is timed
+# and its growth of the process peak memory recorded on its own. A stage
+# whose time grows faster than size ** --limit between two neighbouring
+# sizes of a sweep is flagged, which shows where each builder stops scaling.
+#
+# Usage: python bench_scaling.py [--prefixes 24,20,16,12,8] [--floors 1,10,100,500]
+#                                [--interfaces 32,128,512,2048] [--runs 3] [-o results.jsonl]
+
+import json
+import math
+import optparse
+import os
+import subprocess
+import sys
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# Runs the build described by the JSON spec on stdin in this interpreter and
+# prints the stages as (name, seconds, peak memory growth in KB). A build
+# that fails keeps the stages before the failing one and the error
+probe = '''
+import ast, gc, json, resource, StringIO, sys, time, types
+spec = json.loads(sys.stdin.read())
+sys.path.insert(0, spec['path'])
+import fleet_build
+fleet_build.install_cvplibrary()
+fleet_build.Form.fields = spec['form']
+fleet_build.CVPGlobalVariables.values = spec['gv']
+
+class Server(object):
+    def __init__(self, url):
+        pass
+    def runCmds(self, version, commands):
+        return [spec['eapi'][command] for command in commands]
+sys.modules['jsonrpclib'] = types.ModuleType('jsonrpclib')
+sys.modules['jsonrpclib'].Server = Server
+
+def peak_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+with open(spec['builder']) as f:
+    tree = ast.parse(f.read(), spec['builder'])
+stages = [('setup', list())]
+for node in tree.body:
+    call = node.value if isinstance(node, ast.Expr) else None
+    if (isinstance(call, ast.Call) and getattr(call.func, 'id', None) == 'mark_phase'
+            and isinstance(call.args[0], ast.Str)):
+        stages.append((call.args[0].s, list()))
+    stages[-1][1].append(node)
+
+scope = {'__name__': '__main__', 'Form': fleet_build.Form}
+# Collections of the whole heap would land in whichever stage is running, so
+# the garbage collector is off while the stages run, as in timeit
+report = {'stages': list()}
+sys.stdout = StringIO.StringIO()
+gc.collect()
+gc.disable()
+try:
+    for name, nodes in stages:
+        code = compile(ast.Module(nodes), spec['builder'], 'exec')
+        before = peak_kb()
+        start = time.time()
+        exec code in scope
+        report['stages'].append((name, time.time() - start, peak_kb() - before))
+except Exception, e:
+    report['error'] = '%s in %s: %s' % (type(e).__name__, name, e)
+report['peak_kb'] = peak_kb()
+sys.stdout = sys.__stdout__
+print json.dumps(report)
+'''
+
+
+def spine_spec(prefixlen, count):
+    ports = ['Ethernet%s' % n for n in range(1, count + 1)] + ['Management1']
+    form = {'supernet': '10.0.0.0/%s' % prefixlen, 'lo0': '10.255.255.1', 'asn': '65000',
+            'leaf_asn': '65001-65999'}
+    gv = {'CVP_MAC': '00:1c:73:00:00:01', 'CVP_IP': '10.1.1.1', 'ZTP_STATE': 'false',
+          'CVP_USERNAME': 'cvpadmin', 'CVP_PASSWORD': 'arista'}
+    eapi = {'show interfaces status': {'interfaceStatuses': dict((p, {}) for p in ports)}}
+    return {'builder': os.path.join(here, 'SAMPLE-SpineBuilder.py'),
+            'form': form, 'gv': gv, 'eapi': eapi}
+
+
+def remote_spec(prefixlen, floors):
+    form = {'hostname': 'BLDG1-1', 'base_net': '10.0.0.0/%s' % prefixlen, 'floors': str(floors),
+            'wan_p2p': '172.16.0.0/31', 'wan_intf': 'Ethernet48', 'peerlink': 'Ethernet49,Ethernet50',
+            'wan_as': '65000', 'local_as': '65100', 'rp': '10.255.255.1', 'dhcp': '10.9.9.9'}
+    return {'builder': os.path.join(here, 'SAMPLE-RemoteBuilding.py'),
+            'form': form, 'gv': dict(), 'eapi': dict()}
+
+
+# Runs spec runs times and returns the median of each stage and the error if it failed
+def measure(spec, runs):
+    spec = dict(spec, path=here)
+    env = dict(os.environ, PRIMARY_DEVICE_INTF_IP='10.0.0.1')
+    reports = list()
+    for _ in range(runs):
+        process = subprocess.Popen([sys.executable, '-c', probe], stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, env=env)
+        output = process.communicate(json.dumps(spec))[0]
+        reports.append(json.loads(output))
+    stages = list()
+    for index, (name, _, _) in enumerate(reports[0]['stages']):
+        times = sorted(report['stages'][index][1] for report in reports)
+        grown = sorted(report['stages'][index][2] for report in reports)
+        stages.append((name, times[len(times) // 2], grown[len(grown) // 2]))
+    result = {'stages': stages, 'peak_kb': max(report['peak_kb'] for report in reports)}
+    if 'error' in reports[0]:
+        result['error'] = reports[0]['error']
+    return result
+
+
+# Returns a line for every stage whose time grows faster than size ** limit
+# between two neighbouring sizes of dimension, the other dimensions the same
+# Stages that did not run at both sizes are skipped
+def find_superlinear(results, dimension, limit, min_seconds):
+    flags = list()
+    groups = dict()
+    for result in results:
+        others = tuple(sorted((k, v) for k, v in result['sizes'].items() if k != dimension))
+        groups.setdefault(others, list()).append(result)
+    for others, group in sorted(groups.items()):
+        group.sort(key=lambda result: result['sizes'][dimension])
+        for small, large in zip(group, group[1:]):
+            ratio = float(large['sizes'][dimension]) / small['sizes'][dimension]
+            for (name, t1, _), (_, t2, _) in zip(small['stages'], large['stages']):
+                if t2 < min_seconds or t1 <= 0 or ratio <= 1:
+                    continue
+                exponent = math.log(t2 / t1) / math.log(ratio)
+                if exponent > limit:
+                    flags.append('%s %s grows as n^%.2f with %s %s -> %s (%s)'
+                                 % (large['builder'], name, exponent, dimension,
+                                    small['params'][dimension], large['params'][dimension],
+                                    ', '.join('%s %s' % (k, large['params'][k]) for k, _ in others)))
+    return flags
+
+
+def print_table(builder, dimension, results):
+    stages = [name for name, _, _ in max((r['stages'] for r in results), key=len)]
+    print builder
+    print '%-10s %10s' % ('supernet', dimension) + ''.join(' %19s' % name for name in stages) + ' %8s' % 'peak MB'
+    for result in results:
+        line = '%-10s %10s' % ('/%s' % result['params']['supernet'], result['params'][dimension])
+        for name, seconds, grown in result['stages']:
+            line += ' %9.2fms %6sK' % (seconds * 1000, grown)
+        if 'error' in result:
+            line += ' %s' % result['error']
+        else:
+            line += ' %8.1f' % (result['peak_kb'] / 1024.0)
+        print line
+    print
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--prefixes', default='24,20,16,12,8', help='supernet prefix lengths [%default]')
+    parser.add_option('--floors', default='1,10,100,500', help='RemoteBuilding floors [%default]')
+    parser.add_option('--interfaces', default='32,128,512,2048',
+                      help='SpineBuilder interfaces [%default]')
+    parser.add_option('--runs', type='int', default=3, help='builds per size, the median is kept [%default]')
+    parser.add_option('--limit', type='float', default=1.3,
+                      help='flag stages growing faster than size ** limit [%default]')
+    parser.add_option('--min-ms', type='float', default=2.0,
+                      help='stages faster than this are not flagged [%default]')
+    parser.add_option('-o', '--output', help='also write the results to this file as JSON lines')
+    options, args = parser.parse_args()
+    prefixes = [int(p) for p in options.prefixes.split(',')]
+
+    sweeps = [
+        ('SpineBuilder', 'interfaces', [int(n) for n in options.interfaces.split(',')], spine_spec),
+        ('RemoteBuilding', 'floors', [int(n) for n in options.floors.split(',')], remote_spec),
+    ]
+    flags = list()
+    output = open(options.output, 'w') if options.output else None
+    for builder, dimension, counts, make_spec in sweeps:
+        results = list()
+        for prefixlen in prefixes:
+            for count in counts:
+                result = measure(make_spec(prefixlen, count), options.runs)
+                result['builder'] = builder
+                result['params'] = {'supernet': prefixlen, dimension: count}
+                result['sizes'] = {'supernet': 2 ** (32 - prefixlen), dimension: count}
+                results.append(result)
+                if output:
+                    output.write(json.dumps(result) + '\n')
+        print_table(builder, dimension, results)
+        for swept in ('supernet', dimension):
+            flags.extend(find_superlinear(results, swept, options.limit, options.min_ms / 1000))
+
+    if output:
+        output.close()
+    for flag in flags:
+        print 'superlinear: %s' % flag
+    if not flags:
+        print 'no stage grows faster than n^%s' % options.limit
+    return 1 if flags else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
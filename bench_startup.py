@@ -0,0 +1,63 @@
+# Cold-start benchmark for the configlet builders.
+# CVP runs every builder in a fresh interpreter, so the module level imports
+# are paid on every build. For each builder this runs only its module level
+# imports in a new interpreter, several times, and reports the median time
+# and the number of modules loaded.
+#
+# Usage: python bench_startup.py [--runs 10] [SAMPLE-SpineBuilder.py ...]
+
+import ast
+import glob
+import optparse
+import os
+import subprocess
+import sys
+
+
+# Runs the imports given as source in a new interpreter, with an empty
+# cvplibrary module standing in for CVP's, and returns (seconds, modules loaded)
+probe = '''
+import sys, time, imp
+cvplibrary = sys.modules['cvplibrary'] = imp.new_module('cvplibrary')
+cvplibrary.Form = cvplibrary.RestClient = None
+cvplibrary.CVPGlobalVariables = cvplibrary.GlobalVariableNames = None
+before = len(sys.modules)
+start = time.time()
+exec compile(%r, 'imports', 'exec')
+print time.time() - start, len(sys.modules) - before
+'''
+
+
+def get_imports(path):
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+    lines = open(path).read().splitlines()
+    imports = [node for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom))]
+    return '\n'.join(lines[node.lineno - 1].strip() for node in imports)
+
+
+def measure(path, runs):
+    code = probe % get_imports(path)
+    times = list()
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', code])
+        elapsed, modules = output.split()
+        times.append(float(elapsed))
+    return sorted(times)[len(times) // 2], int(modules)
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [builder.py ...]')
+    parser.add_option('--runs', type='int', default=10, help='interpreters per builder [%default]')
+    options, args = parser.parse_args()
+    here = os.path.dirname(os.path.abspath(__file__))
+    builders = args or sorted(glob.glob(os.path.join(here, 'SAMPLE-*.py')))
+
+    print '%-28s %10s %8s' % ('builder', 'import ms', 'modules')
+    for path in builders:
+        elapsed, modules = measure(path, options.runs)
+        print '%-28s %10.1f %8s' % (os.path.basename(path), elapsed * 1000, modules)
+
+
+if __name__ == '__main__':
+    main()
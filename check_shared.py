@@ -0,0 +1,114 @@
+# Drift check for the code the configlet builders share.
+# CVP runs every builder as one self-contained script, so helpers used by
+# several builders are copied into each of them. This compares the copies of
+# each shared function and class, with the comment lines right above it, and
+# reports any that differ:
+#  calls      latency budget, retries and breaker (eAPI builders)
+#  metrics    phase timing and call metrics (every builder)
+#  ledger     on-disk IPAM ledger (SpineBuilder and RemoteBuilding)
+#  addresses  int-based IPv4 helpers
+# LeafBuilderv2 is indented by 2 spaces instead of 4, so block indentation is
+# compared in levels. Continuation lines keep their alignment.
+#
+# Usage: python check_shared.py [SAMPLE-*.py ...]
+
+import ast
+import difflib
+import glob
+import optparse
+import os
+import StringIO
+import sys
+import tokenize
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+shared = [
+    ('calls', ['DeviceUnavailable', 'is_transient', 'call_with_timeout', 'call_device']),
+    ('metrics', ['mark_phase', 'instrument', 'record_call', 'get_metrics_report', 'format_metrics',
+                 'write_metrics']),
+    ('ledger', ['get_nth_subnet', 'Ledger']),
+    ('addresses', ['int_to_ip', 'IPv4Network']),
+]
+
+
+# Returns line number -> line number of the logical line it continues, for
+# lines inside a multi-line string None as they are compared as they are
+def get_logical_starts(source):
+    starts = dict()
+    start = None
+    for kind, _, (row, _), (end_row, _), _ in tokenize.generate_tokens(StringIO.StringIO(source).readline):
+        if kind == tokenize.NEWLINE:
+            start = None
+            continue
+        if kind in (tokenize.NL, tokenize.COMMENT, tokenize.INDENT, tokenize.DEDENT):
+            continue
+        if start is None:
+            start = row
+        starts.setdefault(row, start)
+        for inner in range(row + 1, end_row + 1):
+            starts[inner] = None
+    return starts
+
+
+# Returns name -> lines of each top level function and class in path, with
+# the comment lines above it and the indentation of its statements in levels
+def get_blocks(path):
+    with open(path) as f:
+        source = f.read()
+    lines = source.split('\n')
+    tree = ast.parse(source, path)
+    defs = [node for node in tree.body if isinstance(node, (ast.FunctionDef, ast.ClassDef))]
+    unit = defs[0].body[0].col_offset if defs else 4
+    starts = get_logical_starts(source)
+    blocks = dict()
+    for index, node in enumerate(tree.body):
+        if node not in defs or node.name in blocks:
+            continue
+        first = node.lineno - 1
+        last = tree.body[index + 1].lineno - 1 if index + 1 < len(tree.body) else len(lines)
+        while last > first and (not lines[last - 1].strip() or lines[last - 1].startswith('#')):
+            last -= 1
+        while first > 0 and lines[first - 1].startswith('#'):
+            first -= 1
+        block = list()
+        for number in range(first + 1, last + 1):
+            line = lines[number - 1]
+            start = starts.get(number, number)
+            if start is None:
+                block.append(line)
+                continue
+            head = lines[start - 1]
+            indent = len(head) - len(head.lstrip(' '))
+            shift = indent * 4 // unit - indent
+            block.append(' ' * (len(line) - len(line.lstrip(' ')) + shift) + line.lstrip(' ') if line.strip() else '')
+        blocks[node.name] = block
+    return blocks
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [builders]')
+    options, args = parser.parse_args()
+    paths = args or sorted(glob.glob(os.path.join(here, 'SAMPLE-*.py')))
+    builders = [(os.path.basename(path), get_blocks(path)) for path in paths]
+
+    drifted = 0
+    for group, names in shared:
+        for name in names:
+            copies = [(builder, blocks[name]) for builder, blocks in builders if name in blocks]
+            for builder, block in copies[1:]:
+                if block != copies[0][1]:
+                    drifted += 1
+                    print '%s: %s differs between %s and %s' % (group, name, copies[0][0], builder)
+                    for line in difflib.unified_diff(copies[0][1], block, copies[0][0], builder, lineterm='', n=1):
+                        print line
+            if len(copies) == 1:
+                print '%s: %s is only in %s' % (group, name, copies[0][0])
+    if not drifted:
+        print 'shared code is identical in %s builders' % len(builders)
+    return 1 if drifted else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,146 @@
+# Dependency-aware fabric build for the configlet builders.
+# Takes the same device table as fleet_build.py and orders the builder runs
+# by what they depend on:
+#  SpineBuilder     no dependencies
+#  LeafBuilder(v2)  every spine, so the spine plan can be handed over
+#  RemoteBuilding   no dependencies
+# Runs are grouped into waves by dependency depth and every wave is run on a
+# pool of processes, so a full fabric takes as long as its longest chain
+# instead of as long as its device count. Both leaves of an MLAG pair run in
+# the same process one after the other, so they can share a pair_dir record.
+#
+# Leaves are given the plan of the spines built before them through
+# SPINE_PLAN_FILE: the spine supernet Form value and the address each
+# interface got in the spine configlet, so spines allocating from an
+# ipam_dir ledger are planned as they were built. A row may set "wave" to
+# override its place in the order.
+#
+# Usage: python fabric_build.py fabric.csv -o configlets [-j 8] [--cvp https://cvp]
+
+import json
+import multiprocessing
+import optparse
+import os
+import re
+import sys
+import time
+
+import fleet_build
+
+
+# Builder kind -> kinds it depends on
+dependencies = {
+    'spine': [],
+    'leaf': ['spine'],
+    'remote': [],
+}
+
+
+def get_kind(row):
+    name = os.path.basename(row['builder'])
+    if 'Spine' in name:
+        return 'spine'
+    if 'Leaf' in name:
+        return 'leaf'
+    return 'remote'
+
+
+def get_depth(kind):
+    return 1 + max([get_depth(dep) for dep in dependencies[kind]] or [-1])
+
+
+# MLAG peers are numbered 1 and 2, 3 and 4 and so on
+def get_pair(device):
+    stem = device.rstrip('0123456789')
+    if stem == device:
+        return device
+    number = int(device[len(stem):])
+    return '%s%s' % (stem, (number + 1) // 2)
+
+
+# Returns the waves to run in order, each a list of groups of rows that run
+# one after the other in one process
+def get_waves(rows):
+    waves = dict()
+    for row in rows:
+        kind = get_kind(row)
+        depth = int(row['wave']) if row.get('wave') else get_depth(kind)
+        key = get_pair(row['device']) if kind == 'leaf' else row['device']
+        groups = waves.setdefault(depth, dict())
+        groups.setdefault((kind, key), list()).append(row)
+    return [[sorted(group, key=lambda row: row['device']) for group in waves[wave].values()]
+            for wave in sorted(waves.keys())]
+
+
+def build_group(args):
+    rows, outdir = args
+    return [fleet_build.build_device((row, outdir)) for row in rows]
+
+
+# Spine plan entries from built spine configlets,
+# hostname -> (supernet, interface -> spine address)
+def get_spine_plan(rows, outdir):
+    plan = dict()
+    for row in rows:
+        path = os.path.join(outdir, '%s.cfg' % row['device'])
+        if get_kind(row) != 'spine' or not os.path.exists(path):
+            continue
+        with open(path) as f:
+            stanzas = re.findall(r'^interface (\S+)\n(?:   .*\n)*?   ip address ([\d.]+)/', f.read(), re.M)
+        addresses = dict((intf, address) for intf, address in stanzas
+                         if intf.startswith('Ethernet') and '-' not in intf)
+        plan[row['device']] = (row['supernet'], addresses)
+    return plan
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] fabric.csv|fabric.yaml')
+    parser.add_option('-o', '--outdir', default='configlets',
+                      help='directory to write configlets to [%default]')
+    parser.add_option('-j', '--jobs', type='int', default=multiprocessing.cpu_count(),
+                      help='number of builder processes [%default]')
+    parser.add_option('--cvp', help='CVP URL used for builder REST calls')
+    parser.add_option('--cvp-user', help='CVP username for --cvp')
+    parser.add_option('--cvp-password', help='CVP password for --cvp')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('a device table is required')
+
+    rows = fleet_build.read_rows(args[0])
+    if not os.path.isdir(options.outdir):
+        os.makedirs(options.outdir)
+    plan_file = os.path.abspath(os.path.join(options.outdir, '.spine_plan.json'))
+
+    pool = multiprocessing.Pool(options.jobs, fleet_build.install_cvplibrary,
+                                (options.cvp, options.cvp_user, options.cvp_password))
+    failed = 0
+    built = list()
+    for number, wave in enumerate(get_waves(rows)):
+        plan = get_spine_plan(built, options.outdir)
+        with open(plan_file, 'w') as f:
+            json.dump(plan, f)
+        for group in wave:
+            for row in group:
+                if get_kind(row) == 'leaf':
+                    row['env.SPINE_PLAN_FILE'] = plan_file
+
+        start = time.time()
+        devices = 0
+        for results in pool.imap_unordered(build_group, [(group, options.outdir) for group in wave]):
+            for device, error in results:
+                devices += 1
+                if error:
+                    failed += 1
+                    sys.stderr.write('%s: %s\n' % (device, error))
+        built.extend(row for group in wave for row in group)
+        sys.stderr.write('wave %s: %s devices in %.2fs\n' % (number, devices, time.time() - start))
+    pool.close()
+    pool.join()
+
+    sys.stderr.write('%s configlets written to %s, %s failed\n'
+                     % (len(rows) - failed, options.outdir, failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,153 @@
+# Fabric topology crawler for the leaf builders.
+# Walks every device in the CVP inventory, several at a time, pulls its LLDP
+# neighbors and interface addresses in one eAPI call and writes them to one
+# adjacency index that LeafBuilder and LeafBuilderv2 read with topology_index
+# set, instead of discovering their uplinks on every build:
+#  devices    system MAC -> hostname, management address, ZTP mode, time crawled
+#  hostnames  hostname -> system MAC
+#  links      "<MAC> <port>" -> [neighbor MAC, neighbor port]
+#  addresses  "<MAC> <port>" -> [address, mask length]
+#
+# Rerunning it against an existing index crawls every device again, so
+# re-addressed devices are picked up even when their LLDP neighbors did not
+# change. Devices that cannot be reached keep their entries and the time they
+# were last crawled, and leaves stop using them after topology_ttl.
+#
+# With --inventory-dir the inventory read from CVP is also written there as
+# the snapshot the leaf builders read with inventory_dir set.
+#
+# Usage: python fabric_crawl.py --cvp https://cvp -o topology.json [-j 16] [--http]
+#                               [--inventory-dir inventory]
+
+import json
+import optparse
+import os
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+
+import fleet_build
+
+
+def get_inventory():
+    url = fleet_build.RestClient.cvp_url + '/cvpservice/inventory/getInventory.do?startIndex=0&endIndex=0'
+    return json.loads(fleet_build.RestClient.opener.open(url).read())['netElementList']
+
+
+# Writes the inventory snapshot of the leaf builders, MAC -> [time fetched, entry]
+def write_inventory(directory, inventory, fetched):
+    path = os.path.join(directory, 'inventory.json')
+    with open(path + '.crawl', 'w') as f:
+        json.dump(dict((element['systemMacAddress'], [fetched, element]) for element in inventory), f)
+    os.rename(path + '.crawl', path)
+
+
+def to_mac(chassis_id):
+    digits = chassis_id.replace('.', '').replace(':', '')
+    return ':'.join(a + b for a, b in zip(digits[::2], digits[1::2]))
+
+
+def run_commands(options, ip, commands):
+    import jsonrpclib
+    scheme = 'http' if options.http else 'https'
+    url = '%s://%s:%s@%s/command-api' % (scheme, options.user, options.password, ip)
+    return jsonrpclib.Server(url).runCmds(1, commands)
+
+
+# Returns (mac, links, addresses), or (mac, error) if the device could not be crawled
+def crawl_device(args):
+    options, element = args
+    mac = element['systemMacAddress']
+    try:
+        lldp, interfaces = run_commands(options, element['ipAddress'],
+                                        ['show lldp neighbors detail', 'show ip interface'])
+        links = dict()
+        for port, info in lldp['lldpNeighbors'].items():
+            if info['lldpNeighborInfo']:
+                neighbor = info['lldpNeighborInfo'][0]
+                neighbor_port = neighbor['neighborInterfaceInfo']['interfaceId'].replace('"', '')
+                links[port] = [to_mac(neighbor['chassisId']), neighbor_port]
+        addresses = dict()
+        for port, info in interfaces['interfaces'].items():
+            primary = info['interfaceAddress']['primaryIp']
+            if primary['address'] != '0.0.0.0':
+                addresses[port] = [primary['address'], primary['maskLen']]
+        return mac, links, addresses
+    except Exception, e:
+        return mac, '%s: %s' % (type(e).__name__, e)
+
+
+# Groups the entries of an index table by the device MAC their key starts with
+def group_by_device(table):
+    groups = dict()
+    for key, value in table.items():
+        groups.setdefault(key.split(' ')[0], list()).append((key, value))
+    return groups
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-o', '--output', default='topology.json', help='index to write [%default]')
+    parser.add_option('-j', '--jobs', type='int', default=16, help='devices crawled at a time [%default]')
+    parser.add_option('--cvp', help='CVP URL to read the inventory from')
+    parser.add_option('--cvp-user', help='CVP username for --cvp')
+    parser.add_option('--cvp-password', help='CVP password for --cvp')
+    parser.add_option('--user', help='eAPI username [--cvp-user]')
+    parser.add_option('--password', help='eAPI password [--cvp-password]')
+    parser.add_option('--http', action='store_true', help='use http for eAPI instead of https')
+    parser.add_option('--inventory-dir', help='also write the inventory snapshot to this directory')
+    options, args = parser.parse_args()
+    if not options.cvp:
+        parser.error('--cvp is required')
+    options.user = options.user or options.cvp_user
+    options.password = options.password or options.cvp_password
+
+    fleet_build.install_cvplibrary(options.cvp, options.cvp_user, options.cvp_password)
+    old = {'time': 0, 'devices': dict(), 'links': dict(), 'addresses': dict()}
+    if os.path.exists(options.output):
+        with open(options.output) as f:
+            old = json.load(f)
+
+    start = time.time()
+    inventory = get_inventory()
+    if options.inventory_dir:
+        write_inventory(options.inventory_dir, inventory, start)
+    pool = ThreadPool(options.jobs)
+    results = pool.map(crawl_device, [(options, element) for element in inventory])
+    pool.close()
+    old_entries = dict((table, group_by_device(old[table])) for table in ('links', 'addresses'))
+
+    index = {'time': time.time(), 'devices': dict(), 'hostnames': dict(), 'links': dict(), 'addresses': dict()}
+    counts = {'crawled': 0, 'failed': 0}
+    for element, result in zip(inventory, results):
+        mac = element['systemMacAddress']
+        device = {'hostname': element['fqdn'].split('.')[0], 'ipAddress': element['ipAddress'],
+                  'ztpMode': element['ztpMode'], 'time': start}
+        if len(result) == 2:
+            counts['failed'] += 1
+            sys.stderr.write('%s: %s\n' % (device['hostname'], result[1]))
+            if mac not in old['devices']:
+                continue
+            device['time'] = old['devices'][mac].get('time', old['time'])
+            for table in ('links', 'addresses'):
+                index[table].update(old_entries[table].get(mac, []))
+        else:
+            counts['crawled'] += 1
+            _, links, addresses = result
+            for port, link in links.items():
+                index['links']['%s %s' % (mac, port)] = link
+            for port, address in addresses.items():
+                index['addresses']['%s %s' % (mac, port)] = address
+        index['devices'][mac] = device
+        index['hostnames'][device['hostname']] = mac
+
+    with open(options.output + '.tmp', 'w') as f:
+        json.dump(index, f, sort_keys=True, separators=(',', ':'))
+    os.rename(options.output + '.tmp', options.output)
+    sys.stderr.write('%s devices in %.2fs: %s crawled, %s failed\n'
+                     % (len(inventory), time.time() - start, counts['crawled'], counts['failed']))
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,274 @@
+# Local stand-in for a fabric of EOS switches and the CVP REST API.
+# Serves eAPI runCmds at /command-api and the CVP endpoints used by the
+# builders from a generated leaf/spine topology, with a configurable latency
+# and jitter added to every call and a count of the calls made.
+#
+# Devices are told apart by the address in the Host header, so the whole
+# fabric is served from one port on 127.x.y.z addresses. Plain HTTP and TLS
+# are accepted on the same port when a certificate is given.
+#
+# Usage: python fake_fabric.py [--spines 2] [--leaves 8] [--latency 0.05]
+
+import BaseHTTPServer
+import SocketServer
+import json
+import optparse
+import random
+import socket
+import ssl
+import sys
+import threading
+import time
+import urlparse
+
+
+# Functions to generate the topology
+def device_ip(kind, number):
+    return '127.%s.%s.%s' % (kind, number // 256, number % 256)
+
+
+def device_mac(kind, number):
+    return '00:1c:73:%02x:%02x:%02x' % (kind, number // 256, number % 256)
+
+
+def ip_interface(intf, address, mask_len=31):
+    primary = {'address': address, 'maskLen': mask_len}
+    return {'interfaces': {intf: {'interfaceAddress': {'primaryIp': primary}}}}
+
+
+def lldp_neighbor(mac, hostname, intf):
+    chassis = mac.replace(':', '')
+    chassis = '.'.join(chassis[i:i+4] for i in range(0, 12, 4))
+    info = {'chassisId': chassis, 'systemName': '%s.lab' % hostname,
+            'neighborInterfaceInfo': {'interfaceId': '"%s"' % intf}}
+    return {'lldpNeighborInfo': [info]}
+
+
+# Builds a fabric of spines and MLAG leaf pairs. Leaf n connects Ethernet2 to
+# port Ethernet<n> on the first spine and Ethernet3 to the same port on the
+# second, and each spine addresses its ports the way SpineBuilder does and
+# sees the leaves over LLDP.
+# Every leaf also sees neighbors extra hosts on ports from Ethernet101 up.
+# Returns a dict with the devices, CVP net elements, DNS entries and the
+# fleet_build rows to run each builder with.
+def build_topology(spines=2, leaves=8, port=8080, neighbors=0):
+    ports = ['Ethernet%s' % n for n in range(1, max(leaves, 32) + 1)]
+    topology = {'devices': dict(), 'net_elements': list(), 'dns': dict(), 'rows': dict()}
+    for key in ('spine', 'leaf', 'leafv2'):
+        topology['rows'][key] = list()
+
+    def add_device(kind, number, hostname, commands):
+        ip = device_ip(kind, number)
+        mac = device_mac(kind, number)
+        topology['devices'][ip] = {'hostname': hostname, 'commands': commands}
+        topology['net_elements'].append({'systemMacAddress': mac, 'fqdn': '%s.lab' % hostname,
+                                         'ipAddress': '%s:%s' % (ip, port), 'ztpMode': 'false'})
+        gv = {'gv.CVP_MAC': mac, 'gv.CVP_IP': '%s:%s' % (ip, port), 'gv.ZTP_STATE': 'false',
+              'gv.CVP_USERNAME': 'cvpadmin', 'gv.CVP_PASSWORD': 'arista'}
+        return ip, mac, gv
+
+    status = {'interfaceStatuses': dict((p, {}) for p in ports + ['Management1'])}
+    spine_macs = list()
+    for number in range(1, spines + 1):
+        hostname = 'spine%s' % number
+        supernet = '10.%s.0.0/16' % number
+        commands = {'show interfaces status': status, 'show ip interface': {'interfaces': dict()},
+                    'show lldp neighbors detail': {'lldpNeighbors': dict()}}
+        for index, intf in enumerate(sorted(ports)):
+            address = '10.%s.%s.%s' % (number, index * 2 // 256, index * 2 % 256)
+            commands['show ip interface %s' % intf] = ip_interface(intf, address)
+            commands['show ip interface']['interfaces'].update(ip_interface(intf, address)['interfaces'])
+        ip, mac, gv = add_device(1, number, hostname, commands)
+        spine_macs.append((mac, hostname, commands['show lldp neighbors detail']['lldpNeighbors']))
+        form = {'supernet': supernet, 'lo0': '10.255.0.%s' % number, 'asn': '65000',
+                'leaf_asn': '65001-65999'}
+        topology['rows']['spine'].append(dict(form, device=hostname, **gv))
+
+    for number in range(1, leaves + 1):
+        hostname = 'leaf%s' % number
+        peer = number + 1 if number % 2 else number - 1
+        lldp = {'Ethernet1': lldp_neighbor(device_mac(2, peer), 'leaf%s' % peer, 'Ethernet1')}
+        for uplink, (mac, spine, spine_lldp) in zip(['Ethernet2', 'Ethernet3'], spine_macs[:2]):
+            lldp[uplink] = lldp_neighbor(mac, spine, 'Ethernet%s' % number)
+            spine_lldp['Ethernet%s' % number] = lldp_neighbor(device_mac(2, number), hostname, uplink)
+        for host in range(neighbors):
+            lldp['Ethernet%s' % (101 + host)] = lldp_neighbor(device_mac(4, host), 'host%s' % host, 'eth0')
+        commands = {'show lldp neighbors detail': {'lldpNeighbors': lldp},
+                    'show ip interface': {'interfaces': dict()}}
+        for intf in lldp:
+            commands['show lldp neighbors %s detail' % intf] = {'lldpNeighbors': {intf: lldp[intf]}}
+        ip, mac, gv = add_device(2, number, hostname, commands)
+
+        pair = (number + 1) // 2
+        loopback = '10.254.%s.%s' % (number // 256, number % 256)
+        mgmt_ip = device_ip(3, number)
+        topology['dns'][mgmt_ip] = '%s.lab' % hostname
+        topology['dns'][hostname] = loopback
+        form = {'lo0': loopback, 'lo1': '10.253.%s.%s' % (pair // 256, pair % 256),
+                'lo1_sec': '10.252.%s.%s' % (pair // 256, pair % 256),
+                'mlag_subnet': '192.168.0.0/30', 'leaf_asn': str(65000 + pair), 'spine_asn': '65000'}
+        topology['rows']['leaf'].append(dict(form, device=hostname, **gv))
+        form = {'mgmt_ip': mgmt_ip, 'bgp_as': str(65000 + pair),
+                'loop_1': '10.253.%s.%s' % (pair // 256, pair % 256), 'snmp_info': ''}
+        topology['rows']['leafv2'].append(dict(form, device=hostname, **gv))
+
+    return topology
+
+
+# HTTP handler answering eAPI and CVP requests from the topology
+class FabricHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, body, code=200):
+        body = json.dumps(body)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.delay('cvp', 'cvp')
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+        elements = self.server.topology['net_elements']
+        if url.path.endswith('/getNetElementById.do'):
+            for element in elements:
+                if element['systemMacAddress'] == query.get('netElementId'):
+                    return self.reply(element)
+            return self.reply({'errorCode': '122401', 'errorMessage': 'Not found'}, 404)
+        if url.path.endswith('/getInventory.do'):
+            start = int(query.get('startIndex', 0))
+            end = int(query.get('endIndex', 0)) or len(elements)
+            return self.reply({'netElementList': elements[start:end], 'total': len(elements)})
+        self.reply({'errorMessage': 'Unknown path %s' % url.path}, 404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.endswith('/authenticate.do'):
+            return self.reply({'sessionId': 'local'})
+
+        host = self.headers.get('Host', '').split(':')[0]
+        self.server.delay('eapi', host)
+        request = json.loads(body)
+        device = self.server.topology['devices'].get(host)
+        if device is None:
+            return self.reply({'errorMessage': 'Unknown device %s' % host}, 404)
+        params = request['params']
+        commands = params['cmds'] if isinstance(params, dict) else params[1]
+        results = list()
+        for command in commands:
+            if command not in device['commands']:
+                error = {'code': 1002, 'message': "CLI command 1 of 1 '%s' failed" % command}
+                return self.reply({'jsonrpc': '2.0', 'id': request['id'], 'error': error})
+            results.append(device['commands'][command])
+        self.reply({'jsonrpc': '2.0', 'id': request['id'], 'result': results})
+
+
+class FabricServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    # Crawls connect to many devices at once
+    request_queue_size = 128
+
+    def __init__(self, topology, address=('', 8080), latency=0.0, jitter=0.0, certfile=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FabricHandler)
+        self.topology = topology
+        self.latency = latency
+        self.jitter = jitter
+        self.certfile = certfile
+        self.lock = threading.Lock()
+        self.handlers = dict()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = {'eapi': 0, 'cvp': 0}
+            self.device_calls = dict()
+            self.in_flight = dict()
+            self.peak = dict()
+
+    # Counts the call and the calls in flight to device at the same time
+    def delay(self, kind, device):
+        with self.lock:
+            self.calls[kind] += 1
+            self.device_calls[device] = self.device_calls.get(device, 0) + 1
+            self.in_flight[device] = self.in_flight.get(device, 0) + 1
+            self.peak[device] = max(self.peak.get(device, 0), self.in_flight[device])
+        time.sleep(self.latency + random.uniform(0, self.jitter))
+        with self.lock:
+            self.in_flight[device] -= 1
+
+    # Builders drop pooled connections without closing them
+    def handle_error(self, request, address):
+        if not isinstance(sys.exc_info()[1], (socket.error, ssl.SSLError)):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, address)
+
+    # TLS connections are wrapped, anything else is served as plain HTTP
+    def get_request(self):
+        sock, address = self.socket.accept()
+        if self.certfile and sock.recv(1, socket.MSG_PEEK) == '\x16':
+            sock = ssl.wrap_socket(sock, certfile=self.certfile, server_side=True)
+        return sock, address
+
+    # Handler threads are kept with their connection so stop() can close it,
+    # builders keep pooled connections open until they exit
+    def process_request(self, request, address):
+        thread = threading.Thread(target=self.process_request_thread, args=(request, address))
+        thread.daemon = True
+        with self.lock:
+            self.handlers[thread] = request
+        thread.start()
+
+    def process_request_thread(self, request, address):
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request, address)
+        finally:
+            with self.lock:
+                self.handlers.pop(threading.current_thread(), None)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    # Stops serving, closes the open connections and waits for their handler
+    # threads, so none of them is still running when the interpreter exits
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        with self.lock:
+            handlers = self.handlers.items()
+        for thread, request in handlers:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except (socket.error, ssl.SSLError):
+                pass
+        for thread, request in handlers:
+            thread.join()
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--spines', type='int', default=2)
+    parser.add_option('--leaves', type='int', default=8)
+    parser.add_option('--neighbors', type='int', default=0, help='extra LLDP neighbors per leaf')
+    parser.add_option('--port', type='int', default=8080)
+    parser.add_option('--latency', type='float', default=0.0, help='seconds added to every call')
+    parser.add_option('--jitter', type='float', default=0.0, help='up to this many extra seconds')
+    parser.add_option('--certfile', help='PEM certificate and key to also accept TLS')
+    options, args = parser.parse_args()
+
+    topology = build_topology(options.spines, options.leaves, options.port, options.neighbors)
+    server = FabricServer(topology, ('', options.port), options.latency,
+                          options.jitter, options.certfile)
+    print 'Serving %s devices on port %s' % (len(topology['devices']), options.port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+# Offline fleet generation for the configlet builders.
+# Runs any of the SAMPLE builders outside of CVP for a table of devices and
+# writes one configlet per device, spread over a pool of processes.
+#
+# Each row of the table describes one device:
+#  builder     path of the builder script to run
+#  device      name of the configlet file written to the output directory
+#  gv.NAME     CVPGlobalVariables value, e.g. gv.CVP_MAC or gv.ZTP_STATE
+#  env.NAME    environment variable, e.g. env.AERIS_INGEST_KEY
+#  any other   Form field, e.g. hostname or base_net
+#
+# Rows are read from CSV, or from YAML (a list of mappings) if PyYAML is
+# installed. Builders that query CVP need --cvp to reach a CVP server.
+#
+# Usage: python fleet_build.py devices.csv -o configlets [-j 8] [--cvp https://cvp]
+
+import csv
+import json
+import multiprocessing
+import optparse
+import os
+import sys
+import types
+import urllib2
+import cookielib
+import StringIO
+
+
+# Stand-in for the cvplibrary module CVP provides to configlet builders
+class Field(object):
+    def __init__(self, value):
+        self.value = value
+
+    def getValue(self):
+        return self.value
+
+
+class Form(object):
+    fields = dict()
+
+    @classmethod
+    def getFieldById(cls, field_id):
+        return Field(cls.fields.get(field_id))
+
+
+class GlobalVariableNames(object):
+    CVP_IP = 'CVP_IP'
+    CVP_MAC = 'CVP_MAC'
+    CVP_SERIAL = 'CVP_SERIAL'
+    CVP_USERNAME = 'CVP_USERNAME'
+    CVP_PASSWORD = 'CVP_PASSWORD'
+    ZTP_STATE = 'ZTP_STATE'
+    ZTP_USERNAME = 'ZTP_USERNAME'
+    ZTP_PASSWORD = 'ZTP_PASSWORD'
+
+
+class CVPGlobalVariables(object):
+    values = dict()
+
+    @classmethod
+    def getValue(cls, name):
+        return cls.values.get(name)
+
+
+class RestClient(object):
+    # Requests to localhost:8080 are sent to cvp_url instead
+    cvp_url = None
+    opener = None
+
+    def __init__(self, url, method):
+        self.url = url
+        self.method = method
+        self.response = None
+
+    def connect(self):
+        if not self.cvp_url:
+            raise RuntimeError('builder queries CVP, rerun with --cvp')
+        url = self.url.replace('http://localhost:8080', self.cvp_url, 1)
+        request = urllib2.Request(url)
+        request.get_method = lambda: self.method
+        self.response = self.opener.open(request).read()
+        return True
+
+    def getResponse(self):
+        return self.response
+
+
+def install_cvplibrary(cvp_url=None, cvp_user=None, cvp_pwd=None):
+    module = types.ModuleType('cvplibrary')
+    module.Form = Form
+    module.CVPGlobalVariables = CVPGlobalVariables
+    module.GlobalVariableNames = GlobalVariableNames
+    module.RestClient = RestClient
+    sys.modules['cvplibrary'] = module
+
+    if cvp_url:
+        RestClient.cvp_url = cvp_url.rstrip('/')
+        RestClient.opener = urllib2.build_opener(
+            urllib2.HTTPCookieProcessor(cookielib.CookieJar()))
+        login = json.dumps({'userId': cvp_user, 'password': cvp_pwd})
+        request = urllib2.Request(RestClient.cvp_url + '/cvpservice/login/authenticate.do',
+                                  login, {'Content-Type': 'application/json'})
+        RestClient.opener.open(request).read()
+
+
+# Functions to read the device table
+def read_rows(path):
+    if path.endswith('.yaml') or path.endswith('.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise SystemExit('PyYAML is required to read %s' % path)
+        with open(path) as f:
+            return [dict((k, str(v)) for k, v in row.items()) for row in yaml.safe_load(f)]
+    with open(path) as f:
+        return [row for row in csv.DictReader(f)]
+
+
+def split_row(row):
+    form = dict()
+    gv = dict()
+    env = dict()
+    for key, value in row.items():
+        if key in ('builder', 'device'):
+            continue
+        elif key.startswith('gv.'):
+            gv[key[3:]] = value
+        elif key.startswith('env.'):
+            env[key[4:]] = value
+        else:
+            form[key] = value
+    return form, gv, env
+
+
+# Runs one builder for one row and writes its configlet
+# Returns (device, error) where error is None on success
+def build_device(args):
+    row, outdir = args
+    device = row['device']
+    form, gv, env = split_row(row)
+    Form.fields = form
+    CVPGlobalVariables.values = gv
+
+    saved_env = dict(os.environ)
+    saved_stdout = sys.stdout
+    os.environ.update(env)
+    sys.stdout = StringIO.StringIO()
+    try:
+        with open(row['builder']) as f:
+            code = compile(f.read(), row['builder'], 'exec')
+        exec code in {'__name__': '__main__', 'Form': Form}
+        configlet = sys.stdout.getvalue()
+    except BaseException, e:
+        return device, '%s: %s' % (type(e).__name__, e)
+    finally:
+        sys.stdout = saved_stdout
+        os.environ.clear()
+        os.environ.update(saved_env)
+
+    with open(os.path.join(outdir, '%s.cfg' % device), 'w') as f:
+        f.write(configlet)
+    return device, None
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] devices.csv|devices.yaml')
+    parser.add_option('-o', '--outdir', default='configlets',
+                      help='directory to write configlets to [%default]')
+    parser.add_option('-j', '--jobs', type='int', default=multiprocessing.cpu_count(),
+                      help='number of builder processes [%default]')
+    parser.add_option('--cvp', help='CVP URL used for builder REST calls')
+    parser.add_option('--cvp-user', help='CVP username for --cvp')
+    parser.add_option('--cvp-password', help='CVP password for --cvp')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('a device table is required')
+
+    rows = read_rows(args[0])
+    if not os.path.isdir(options.outdir):
+        os.makedirs(options.outdir)
+
+    pool = multiprocessing.Pool(options.jobs, install_cvplibrary,
+                                (options.cvp, options.cvp_user, options.cvp_password))
+    failed = 0
+    for device, error in pool.imap(build_device, [(row, options.outdir) for row in rows]):
+        if error:
+            failed += 1
+            sys.stderr.write('%s: %s\n' % (device, error))
+    pool.close()
+    pool.join()
+
+    sys.stderr.write('%s configlets written to %s, %s failed\n'
+                     % (len(rows) - failed, options.outdir, failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+# Telemetry volume estimate for the RemoteBuilding TerminAttr profiles.
+# Reads a state sample recorded from a switch, one "<bytes> <path>" line per
+# state path, and reports how much of it each profile in telemetry_profiles
+# would stream to CVP:
+#  /Smash/<table>/...  dropped when the table is in smash_exclude
+#  /var/log/...        only streamed with taillogs
+#  anything else       dropped when under a path in ingest_exclude
+# The profiles are read from the builder source, so the estimate follows any
+# changes made to them there. Sizes are before compression.
+#
+# Usage: python telemetry_estimate.py sample.txt [SAMPLE-RemoteBuilding.py]
+
+import ast
+import optparse
+import os
+
+
+here = os.path.dirname(os.path.abspath(__file__))
+settings = ('smash_exclude_list', 'ingest_exclude_list', 'telemetry_profiles')
+
+
+# Name set by a module level statement, x = ..., x[key] = ... or x.append(...)
+def get_target(node):
+    if isinstance(node, ast.Assign):
+        target = node.targets[0]
+    elif isinstance(node, ast.Expr) and isinstance(node.value, ast.Call) \
+            and isinstance(node.value.func, ast.Attribute):
+        target = node.value.func.value
+    else:
+        return None
+    if isinstance(target, ast.Subscript):
+        target = target.value
+    return getattr(target, 'id', None)
+
+
+# Runs the module level statements of the builder that set up the profiles
+def load_profiles(path):
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+    nodes = [node for node in tree.body if get_target(node) in settings]
+    scope = dict()
+    exec compile(ast.Module(nodes), path, 'exec') in scope
+    return scope['telemetry_profiles']
+
+
+def read_sample(path):
+    sample = list()
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                size, state_path = line.split(None, 1)
+                sample.append((int(size), state_path))
+    return sample
+
+
+def under(path, prefix):
+    return path == prefix or path.startswith(prefix.rstrip('/') + '/')
+
+
+def is_streamed(path, profile):
+    if under(path, '/var/log'):
+        return profile['taillogs']
+    if under(path, '/Smash'):
+        table = path[len('/Smash/'):].split('/')[0]
+        if table in profile['smash_exclude']:
+            return False
+    return not [prefix for prefix in profile['ingest_exclude'] if under(path, prefix)]
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] sample.txt [builder]')
+    options, args = parser.parse_args()
+    if not 1 <= len(args) <= 2:
+        parser.error('a state sample is required')
+    builder = args[1] if len(args) > 1 else os.path.join(here, 'SAMPLE-RemoteBuilding.py')
+    profiles = load_profiles(builder)
+    sample = read_sample(args[0])
+    total = sum(size for size, _ in sample)
+    if not total:
+        raise SystemExit('%s has no state in it' % args[0])
+
+    streamed = dict((name, sum(size for size, path in sample if is_streamed(path, profile)))
+                    for name, profile in profiles.items())
+    print '%-10s %14s %8s  %s' % ('profile', 'bytes', 'share', 'compression')
+    for name in sorted(streamed.keys(), key=lambda name: (streamed[name], name)):
+        print '%-10s %14s %7.1f%%  %s' % (name, streamed[name], 100.0 * streamed[name] / total,
+                                          profiles[name]['compression'] or 'none')
+
+
+if __name__ == '__main__':
+    main()